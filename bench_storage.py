@@ -0,0 +1,141 @@
+import random
+import sys
+import time
+
+import main_2fa_full as bot
+
+# Đo thời gian parse/serialize và kích thước payload trên dữ liệu shop giả lập,
+# dùng đúng các hàm codec mà bot dùng khi ghi/đọc gist.
+# Chạy: python bench_storage.py [số_khách_hàng]
+
+PRODUCTS = list(bot.CATALOG)
+
+
+def make_customers(count: int):
+    rnd = random.Random(42)
+    now = int(time.time())
+    customers = {}
+    for uid in range(1_000_000, 1_000_000 + count):
+        products = []
+        for idx in range(rnd.randint(1, 4)):
+            code = rnd.choice(PRODUCTS)
+            item = bot.CATALOG[code]
+            products.append({
+                "product_code": code,
+                "product_name": item["name"],
+                "platform": item["platform"],
+                "type": item["type"],
+                "duration_days": int(item["duration_days"]) * rnd.randint(1, 12),
+                "months": rnd.randint(1, 12),
+                "expires_at": now + rnd.randint(-90, 365) * 86400,
+                "order_code": f"{code.upper()}{uid}{idx}",
+                "status": "active",
+                "delivered_by": "system",
+                "account": {"email": f"user{uid}_{idx}@mail.com", "password": f"pw{rnd.randint(0, 10**8)}"},
+                "created_at": now - rnd.randint(0, 365) * 86400,
+            })
+        customers[str(uid)] = {
+            "username": f"user{uid}",
+            "full_name": f"Khách hàng {uid}",
+            "created_at": now - rnd.randint(0, 365) * 86400,
+            "products": products,
+        }
+    return customers
+
+
+def make_orders(count: int):
+    rnd = random.Random(7)
+    now = int(time.time())
+    orders = {}
+    for idx in range(count):
+        code = rnd.choice(PRODUCTS)
+        order_code = f"{code.upper()}{idx:08d}"
+        orders[order_code] = {
+            "order_code": order_code,
+            "payos_order_code": 10**9 + idx,
+            "user_id": 1_000_000 + rnd.randint(0, count),
+            "product_code": code,
+            "months": rnd.randint(1, 12),
+            "price": int(bot.CATALOG[code]["price"]),
+            "coupon_code": "",
+            "status": "paid",
+            "created_at": now - rnd.randint(0, 365) * 86400,
+            "paid_at": now - rnd.randint(0, 365) * 86400,
+            "delivery_status": "delivered",
+        }
+    return orders
+
+
+def codecs():
+    # json_dumps_text/json_loads_text tự chọn orjson nếu có; tạm gỡ orjson để đo bản stdlib
+    engines = [("json", None)]
+    if bot.orjson is not None:
+        engines.append(("orjson", bot.orjson))
+    result = []
+    for name, module in engines:
+        for pretty in (True, False):
+            result.append((f"{name} {'pretty' if pretty else 'compact'}", module, pretty))
+    return result
+
+
+def with_engine(module, fn):
+    def run(arg):
+        saved = bot.orjson
+        bot.orjson = module
+        try:
+            return fn(arg)
+        finally:
+            bot.orjson = saved
+    return run
+
+
+def with_compression(level, fn):
+    # encode_gist_content chỉ nén khi vượt GIST_COMPRESS_MIN_BYTES; đặt 1 để luôn nén
+    def run(arg):
+        saved = bot.GIST_COMPRESS_MIN_BYTES, bot.GIST_COMPRESS_LEVEL
+        bot.GIST_COMPRESS_MIN_BYTES, bot.GIST_COMPRESS_LEVEL = 1, level
+        try:
+            return fn(arg)
+        finally:
+            bot.GIST_COMPRESS_MIN_BYTES, bot.GIST_COMPRESS_LEVEL = saved
+    return run
+
+
+def timed(fn, arg, rounds: int):
+    best = None
+    value = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        value = fn(arg)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, value
+
+
+def run(count: int, rounds: int = 5):
+    datasets = {
+        "customers.json": make_customers(count),
+        "orders.json": make_orders(count * 2),
+    }
+    print(f"orjson: {'có' if bot.orjson is not None else 'không cài'}")
+    for filename, data in datasets.items():
+        print(f"\n{filename} ({len(data)} bản ghi)")
+        print(f"{'codec':<16}{'serialize ms':>14}{'parse ms':>12}{'bytes':>14}")
+        for name, module, pretty in codecs():
+            dumps = with_engine(module, lambda d, pretty=pretty: bot.json_dumps_text(d, pretty=pretty))
+            dump_time, text = timed(dumps, data, rounds)
+            load_time, _ = timed(with_engine(module, bot.json_loads_text), text, rounds)
+            size = len(text.encode("utf-8"))
+            print(f"{name:<16}{dump_time * 1000:>14.1f}{load_time * 1000:>12.1f}{size:>14,}")
+        compact = bot.json_dumps_text(data)
+        plain_size = len(compact.encode("utf-8"))
+        print(f"{'nén (trên JSON gọn)':<20}{'compress ms':>12}{'decompress ms':>15}{'bytes':>12}{'tỉ lệ':>8}")
+        for level in (1, 6, 9):
+            name = f"gzip-b64 l{level}"
+            encode_time, packed = timed(with_compression(level, bot.encode_gist_content), compact, rounds)
+            decode_time, _ = timed(bot.decode_gist_content, packed, rounds)
+            print(f"{name:<20}{encode_time * 1000:>12.1f}{decode_time * 1000:>15.1f}{len(packed):>12,}{plain_size / len(packed):>7.1f}x")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
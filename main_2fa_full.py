@@ -1,18 +1,53 @@
 import json
 import os
+import queue
+import re
+import sqlite3
 import time
 import hmac
+import base64
+import collections
+import contextlib
+import contextvars
+import gzip
 import hashlib
+import heapq
+import itertools
+import threading
 import urllib.parse
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import pyotp
-from typing import Any, Dict, List, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import PlainTextResponse, JSONResponse
 
+try:
+    import orjson
+except ImportError:  # orjson không bắt buộc, thiếu thì dùng json của stdlib
+    orjson = None
+
 # ============================================================
 # ENV
 # ============================================================
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "") or default)
+    except ValueError:
+        return default
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, "") or default)
+    except ValueError:
+        return default
+
+
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 GIST_ID = os.getenv("GIST_ID", "")
 GIST_TOKEN = os.getenv("GIST_TOKEN", "")
@@ -24,6 +59,7 @@ WEBHOOK_URL = f"{CLOUD_RUN_URL}{WEBHOOK_PATH}" if CLOUD_RUN_URL else WEBHOOK_PAT
 TG_BASE_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
 BOT_USERNAME = os.getenv("BOT_USERNAME", "")
 BOT_USERNAME_CACHE = BOT_USERNAME.strip() if BOT_USERNAME else ""
+PROCESS_STARTED_AT = time.time()
 
 _admin_env = os.getenv("ADMIN_CHAT_ID", "")
 try:
@@ -31,11 +67,68 @@ try:
 except ValueError:
     ADMIN_CHAT_ID = 5816758036
 
+def _parse_gist_routes(value: str) -> Dict[str, str]:
+    # "orders.json=<gist_id>,customers.json=<gist_id>"; file không có trong danh sách nằm ở GIST_ID
+    routes: Dict[str, str] = {}
+    for part in value.split(","):
+        filename, sep, gist_id = part.partition("=")
+        if sep and filename.strip() and gist_id.strip():
+            routes[filename.strip()] = gist_id.strip()
+    return routes
+
+
 GIST_URL = f"https://api.github.com/gists/{GIST_ID}" if GIST_ID else ""
+GIST_ROUTES = _parse_gist_routes(os.getenv("GIST_ROUTES", ""))
 GIST_HEADERS = {
     "Authorization": f"token {GIST_TOKEN}",
     "Accept": "application/vnd.github.v3+json",
 }
+GIST_CACHE_TTL = _env_float("GIST_CACHE_TTL", 15.0)
+GIST_FLUSH_INTERVAL = _env_float("GIST_FLUSH_INTERVAL", 2.0)
+# Mặc định ghi JSON gọn (không thụt lề); bật 1 để ghi dạng dễ đọc khi cần sửa tay trên gist
+GIST_PRETTY_JSON = _env_int("GIST_PRETTY_JSON", 0) > 0
+# API gist cắt content ở ~1MB (đọc tiếp qua raw_url); raw_url chỉ phục vụ file tới 10MB
+GIST_MAX_FILE_BYTES = _env_int("GIST_MAX_FILE_BYTES", 10 * 1024 * 1024)
+# File lớn hơn ngưỡng này (byte) được gzip + base64 trước khi lên gist; 0 = tắt
+GIST_COMPRESS_MIN_BYTES = _env_int("GIST_COMPRESS_MIN_BYTES", 0)
+GIST_COMPRESS_LEVEL = _env_int("GIST_COMPRESS_LEVEL", 6)
+
+HTTP_POOL_CONNECTIONS = _env_int("HTTP_POOL_CONNECTIONS", 4)
+HTTP_POOL_MAXSIZE = _env_int("HTTP_POOL_MAXSIZE", 16)
+TG_HTTP_TIMEOUT = _env_float("TG_HTTP_TIMEOUT", 20.0)
+GIST_HTTP_TIMEOUT = _env_float("GIST_HTTP_TIMEOUT", 20.0)
+PAYOS_HTTP_TIMEOUT = _env_float("PAYOS_HTTP_TIMEOUT", 20.0)
+
+# Số worker xử lý update Telegram sau khi webhook trả OK; 0 = xử lý ngay trong request (CPU chỉ cấp khi có request)
+UPDATE_WORKERS = _env_int("UPDATE_WORKERS", 4)
+UPDATE_QUEUE_SIZE = _env_int("UPDATE_QUEUE_SIZE", 1000)
+UPDATE_DRAIN_TIMEOUT = _env_float("UPDATE_DRAIN_TIMEOUT", 20.0)
+UPDATE_DEDUP_WINDOW = _env_int("UPDATE_DEDUP_WINDOW", 2000)
+UPDATE_DEDUP_PERSIST = _env_int("UPDATE_DEDUP_PERSIST", 0) > 0
+USER_SEEN_FLUSH_INTERVAL = _env_float("USER_SEEN_FLUSH_INTERVAL", 300.0)
+
+TG_GLOBAL_RATE = _env_float("TG_GLOBAL_RATE", 28.0)
+TG_CHAT_RATE = _env_float("TG_CHAT_RATE", 1.0)
+TG_CHAT_BURST = _env_int("TG_CHAT_BURST", 3)
+TG_DISPATCH_WORKERS = _env_int("TG_DISPATCH_WORKERS", 4)
+TG_SEND_MAX_ATTEMPTS = _env_int("TG_SEND_MAX_ATTEMPTS", 4)
+TG_SEND_WAIT_TIMEOUT = _env_float("TG_SEND_WAIT_TIMEOUT", 120.0)
+TG_BROADCAST_RATE = _env_float("TG_BROADCAST_RATE", 25.0)
+BROADCAST_CONCURRENCY = _env_int("BROADCAST_CONCURRENCY", 8)
+BROADCAST_CHECKPOINT_EVERY = _env_int("BROADCAST_CHECKPOINT_EVERY", 50)
+BROADCAST_MAX_ATTEMPTS = _env_int("BROADCAST_MAX_ATTEMPTS", 4)
+# Số đợt broadcast đã xong còn giữ lại (chỉ số đếm) trong broadcasts.json
+BROADCAST_HISTORY_LIMIT = _env_int("BROADCAST_HISTORY_LIMIT", 20)
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "gist").strip().lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot_data.sqlite3")
+# Chia users.json / customers.json thành nhiều file theo hash user_id; 1 = 1 file như cũ
+USERS_SHARDS = _env_int("USERS_SHARDS", 1)
+CUSTOMERS_SHARDS = _env_int("CUSTOMERS_SHARDS", 1)
+# Số lần đọc lại/chạy lại khi file bị sửa từ bên ngoài trong lúc storage_update
+STORAGE_CAS_ATTEMPTS = _env_int("STORAGE_CAS_ATTEMPTS", 5)
+# Đơn đang được 1 luồng giao thì luồng khác không giao lại trong khoảng này (giây)
+FINALIZE_CLAIM_TIMEOUT = _env_int("FINALIZE_CLAIM_TIMEOUT", 300)
 
 PAYOS_CLIENT_ID = os.getenv("PAYOS_CLIENT_ID", "")
 PAYOS_API_KEY = os.getenv("PAYOS_API_KEY", "")
@@ -60,6 +153,9 @@ PAID_ORDERS_FILE = "paid_orders.json"
 REMINDER_LOG_FILE = "reminder_log.json"
 FREE_REQUESTS_FILE = "free_requests.json"
 COUPONS_FILE = "coupons.json"
+BROADCASTS_FILE = "broadcasts.json"
+BROADCAST_PROGRESS_FILE = "broadcast_progress.json"
+UPDATE_STATE_FILE = "update_state.json"
 
 # ============================================================
 # CATALOG / DEFAULT CONFIG
@@ -173,12 +269,108 @@ USER_STATE: Dict[int, Dict[str, Any]] = {}
 
 app = FastAPI()
 
+# ============================================================
+# HTTP CLIENTS
+# ============================================================
+# Mỗi upstream 1 session có pool keep-alive riêng để tái sử dụng kết nối TCP/TLS.
+# Chỉ retry GET/HEAD khi lỗi đọc/5xx; lỗi kết nối thì retry cho mọi method vì request chưa được gửi.
+HTTP_UPSTREAMS: Dict[str, Dict[str, Any]] = {
+    "telegram": {"connect_timeout": 5.0, "timeout": TG_HTTP_TIMEOUT, "retries": 2},
+    "github": {"connect_timeout": 5.0, "timeout": GIST_HTTP_TIMEOUT, "retries": 3},
+    "payos": {"connect_timeout": 5.0, "timeout": PAYOS_HTTP_TIMEOUT, "retries": 2},
+}
+HTTP_STATS: Dict[str, Dict[str, int]] = {name: {"requests": 0, "errors": 0} for name in HTTP_UPSTREAMS}
+_HTTP_SESSIONS: Dict[str, requests.Session] = {}
+_HTTP_LOCK = threading.Lock()
+
+
+def _build_http_session(retries: int) -> requests.Session:
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+
+def http_session(upstream: str) -> requests.Session:
+    session = _HTTP_SESSIONS.get(upstream)
+    if session is None:
+        with _HTTP_LOCK:
+            session = _HTTP_SESSIONS.get(upstream)
+            if session is None:
+                session = _build_http_session(int(HTTP_UPSTREAMS[upstream]["retries"]))
+                _HTTP_SESSIONS[upstream] = session
+    return session
+
+
+def http_request(upstream: str, method: str, url: str, **kwargs) -> requests.Response:
+    profile = HTTP_UPSTREAMS[upstream]
+    kwargs.setdefault("timeout", (profile["connect_timeout"], profile["timeout"]))
+    HTTP_STATS[upstream]["requests"] += 1
+    try:
+        return http_session(upstream).request(method, url, **kwargs)
+    except Exception:
+        HTTP_STATS[upstream]["errors"] += 1
+        raise
+
+
+def http_stats() -> Dict[str, Any]:
+    result: Dict[str, Any] = {}
+    for name, counters in HTTP_STATS.items():
+        opened = 0
+        session = _HTTP_SESSIONS.get(name)
+        if session is not None:
+            try:
+                pools = session.get_adapter("https://").poolmanager.pools
+                opened = sum(pools[key].num_connections for key in pools.keys())
+            except Exception:
+                pass
+        result[name] = {
+            **counters,
+            "connections_opened": opened,
+            "connections_reused": max(0, counters["requests"] - counters["errors"] - opened),
+        }
+    return result
+
 # ============================================================
 # GIST HELPERS
 # ============================================================
+JSON_CODEC = "orjson" if orjson is not None else "json"
+
+
+def json_dumps_text(data: Any, pretty: bool = False) -> str:
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        try:
+            return orjson.dumps(data, option=option).decode("utf-8")
+        except TypeError:
+            # orjson không nhận số nguyên quá 64 bit, để stdlib xử lý
+            pass
+    if pretty:
+        return json.dumps(data, indent=2, ensure_ascii=False)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def json_loads_text(text: str) -> Any:
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
 def _safe_json_load(text: str, fallback: Any) -> Any:
     try:
-        return json.loads(text)
+        return json_loads_text(text)
     except Exception:
         return fallback
 
@@ -200,69 +392,1369 @@ def default_inventory() -> Dict[str, Any]:
     return {code: [] for code in CATALOG}
 
 
-def load_gist_json(filename: str, fallback: Any) -> Any:
+# Mỗi gist có 1 snapshot dùng chung cho cả process: 1 lần GET nạp đủ mọi file của gist đó.
+# Giá trị trong snapshot không bị sửa tại chỗ, chỉ thay thế khi ghi.
+# File có thể được chia ra nhiều gist (GIST_ROUTES), mỗi gist có cache, ETag, hàng ghi và khoá riêng
+# nên đọc 1 file không phải tải các file lớn ở gist khác, và các gist được ghi song song.
+_GIST_STATES: Dict[str, Dict[str, Any]] = {}
+_GIST_STATES_LOCK = threading.Lock()
+_NO_DATA = object()
+# Đánh dấu file chờ xoá trong hàng ghi của gist
+_GIST_DELETED = object()
+# Journal của transaction ghi nhiều gist, nằm trong gist chính tới khi transaction ghi xong
+GIST_JOURNAL_PREFIX = "storage_journal."
+_GIST_FLUSH_THREAD: Optional[threading.Thread] = None
+# Tăng mỗi khi 1 file được nạp lại với nội dung mới từ gist (không tính ghi của chính process)
+_GIST_GENERATIONS: Dict[str, int] = {}
+_GIST_POOL = ThreadPoolExecutor(max_workers=max(1, len({GIST_ID, *GIST_ROUTES.values()})), thread_name_prefix="gist")
+GIST_STATS: Dict[str, int] = {
+    "cache_hits": 0,
+    "not_modified": 0,
+    "full_fetches": 0,
+    "files_parsed": 0,
+    "flushes": 0,
+    "files_flushed": 0,
+    "flush_errors": 0,
+    "writes_performed": 0,
+    "writes_skipped": 0,
+    "raw_downloads": 0,
+    "writes_refused": 0,
+    "writes_rejected": 0,
+}
+
+
+def _clone_json(obj: Any) -> Any:
+    if isinstance(obj, dict):
+        return {k: _clone_json(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_clone_json(v) for v in obj]
+    return obj
+
+
+def _content_hash(content: str) -> str:
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def gist_for_file(filename: str) -> str:
+    gist_id = GIST_ROUTES.get(filename)
+    if gist_id is None:
+        # Shard users.03.json đi theo route của users.json
+        match = re.match(r"(.+)\.\d+\.json$", filename)
+        if match:
+            gist_id = GIST_ROUTES.get(match.group(1) + ".json")
+    return gist_id or GIST_ID
+
+
+def _gist_state(gist_id: str) -> Dict[str, Any]:
+    state = _GIST_STATES.get(gist_id)
+    if state is None:
+        with _GIST_STATES_LOCK:
+            state = _GIST_STATES.get(gist_id)
+            if state is None:
+                state = {
+                    "id": gist_id,
+                    "url": f"https://api.github.com/gists/{gist_id}",
+                    "files": None,
+                    "hashes": {},
+                    "raw_urls": {},
+                    "etag": "",
+                    "fetched_at": 0.0,
+                    # File đã save nhưng chưa PATCH lên gist (write-behind), gom lại để ghi 1 lần
+                    "dirty": {},
+                    # File có trên gist nhưng không đọc được (tải raw lỗi, JSON hỏng): cấm ghi đè
+                    "unreadable": set(),
+                    "lock": threading.RLock(),
+                    "flush_lock": threading.Lock(),
+                }
+                _GIST_STATES[gist_id] = state
+    return state
+
+
+def _all_gist_states() -> List[Dict[str, Any]]:
+    return [_gist_state(gist_id) for gist_id in dict.fromkeys([GIST_ID, *GIST_ROUTES.values()])]
+
+
+# Dòng đầu đánh dấu file nén, file JSON thường (không có dòng này) vẫn đọc như cũ
+GIST_GZIP_HEADER = "#gzip-base64\n"
+
+
+def encode_gist_content(content: str) -> str:
+    if GIST_COMPRESS_MIN_BYTES <= 0:
+        return content
+    # Ngưỡng tính theo byte UTF-8: tiếng Việt có dấu chiếm 2-3 byte mỗi ký tự
+    raw = content.encode("utf-8")
+    if len(raw) < GIST_COMPRESS_MIN_BYTES:
+        return content
+    # mtime=0 để cùng nội dung luôn ra cùng chuỗi nén, so hash bỏ qua ghi trùng vẫn đúng
+    packed = gzip.compress(raw, compresslevel=GIST_COMPRESS_LEVEL, mtime=0)
+    return GIST_GZIP_HEADER + base64.b64encode(packed).decode("ascii")
+
+
+def decode_gist_content(content: str) -> str:
+    if not content.startswith(GIST_GZIP_HEADER):
+        return content
+    return gzip.decompress(base64.b64decode(content[len(GIST_GZIP_HEADER):])).decode("utf-8")
+
+
+def _encode_gist_file(data: Any) -> str:
+    return encode_gist_content(json_dumps_text(data, pretty=GIST_PRETTY_JSON))
+
+
+def _download_gist_raw(url: str) -> str:
+    # Đọc từng chunk và dừng ngay khi vượt giới hạn, không nạp file quá lớn vào bộ nhớ
+    headers = {"Authorization": GIST_HEADERS["Authorization"]}
+    with http_request("github", "GET", url, headers=headers, stream=True) as r:
+        if r.status_code != 200:
+            raise RuntimeError(f"HTTP {r.status_code}")
+        buf = bytearray()
+        for chunk in r.iter_content(chunk_size=256 * 1024):
+            buf.extend(chunk)
+            if len(buf) > GIST_MAX_FILE_BYTES:
+                raise RuntimeError(f"larger than {GIST_MAX_FILE_BYTES} bytes")
+    return buf.decode("utf-8")
+
+
+def _fetch_gist_snapshot(state: Dict[str, Any], force: bool = False) -> Dict[str, Any]:
+    with state["lock"]:
+        files = state["files"]
+        if not force and files is not None and time.time() - state["fetched_at"] < GIST_CACHE_TTL:
+            GIST_STATS["cache_hits"] += 1
+            return files
+        headers = dict(GIST_HEADERS)
+        # Còn file chưa đọc được thì tải lại đầy đủ để thử lại, không dùng ETag
+        if files is not None and state["etag"] and not state["unreadable"]:
+            headers["If-None-Match"] = state["etag"]
+        try:
+            r = http_request("github", "GET", state["url"], headers=headers)
+            if r.status_code == 304 and files is not None:
+                GIST_STATS["not_modified"] += 1
+                state["fetched_at"] = time.time()
+                return files
+            if r.status_code != 200:
+                raise RuntimeError(f"HTTP {r.status_code}")
+            gist = r.json()
+        except Exception:
+            if files is not None:
+                return files
+            raise
+        GIST_STATS["full_fetches"] += 1
+        old_hashes = state["hashes"]
+        old_raw_urls = state["raw_urls"]
+        old_unreadable = state["unreadable"]
+        snapshot: Dict[str, Any] = {}
+        hashes: Dict[str, str] = {}
+        raw_urls: Dict[str, str] = {}
+        unreadable = set()
+        for name, meta in (gist.get("files") or {}).items():
+            meta = meta or {}
+            cached = files is not None and name in files and name not in old_unreadable
+            if meta.get("truncated"):
+                # content bị cắt, raw_url đổi theo nội dung nên cùng raw_url thì dùng lại bản cũ
+                raw_url = meta.get("raw_url") or ""
+                if cached and old_raw_urls.get(name) == raw_url:
+                    snapshot[name] = files[name]
+                    hashes[name] = old_hashes.get(name, "")
+                    raw_urls[name] = raw_url
+                    continue
+                try:
+                    content = _download_gist_raw(raw_url)
+                    GIST_STATS["raw_downloads"] += 1
+                except Exception as e:
+                    print(f"GIST READ ERR ({name}): {e}")
+                    if cached:
+                        snapshot[name] = files[name]
+                        hashes[name] = old_hashes.get(name, "")
+                    else:
+                        unreadable.add(name)
+                    continue
+                raw_urls[name] = raw_url
+            else:
+                content = meta.get("content")
+                if content is None:
+                    continue
+            digest = _content_hash(content)
+            # File không đổi so với lần trước thì dùng lại bản đã parse
+            if cached and old_hashes.get(name) == digest:
+                snapshot[name] = files[name]
+                hashes[name] = digest
+                continue
+            GIST_STATS["files_parsed"] += 1
+            try:
+                data = _safe_json_load(decode_gist_content(content), _NO_DATA)
+            except Exception:
+                data = _NO_DATA
+            if data is _NO_DATA:
+                print(f"GIST READ ERR ({name}): invalid JSON")
+                unreadable.add(name)
+                continue
+            snapshot[name] = data
+            hashes[name] = digest
+            _GIST_GENERATIONS[name] = _GIST_GENERATIONS.get(name, 0) + 1
+        for name, data in state["dirty"].items():
+            if data is _GIST_DELETED:
+                snapshot.pop(name, None)
+            else:
+                snapshot[name] = data
+        state["unreadable"] = unreadable
+        state["files"] = snapshot
+        state["hashes"] = hashes
+        state["raw_urls"] = raw_urls
+        state["etag"] = r.headers.get("ETag", "")
+        state["fetched_at"] = time.time()
+        return snapshot
+
+
+def _fetch_all_gists() -> List[Dict[str, Any]]:
+    # Tải song song mọi gist đã cấu hình, trả về các gist đọc được
+    def fetch(state: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        try:
+            _fetch_gist_snapshot(state)
+            return state
+        except Exception as e:
+            print(f"GIST READ ERR ({state['id']}): {e}")
+            return None
+
+    return [state for state in _GIST_POOL.map(fetch, _all_gist_states()) if state is not None]
+
+
+def _cache_gist_file(state: Dict[str, Any], filename: str, data: Any) -> None:
+    with state["lock"]:
+        files = state["files"]
+        if files is None:
+            return
+        files = dict(files)
+        if data is _GIST_DELETED:
+            files.pop(filename, None)
+        else:
+            files[filename] = data
+        state["files"] = files
+
+
+def load_gist_json(filename: str, fallback: Any, copy: bool = True) -> Any:
     if not gist_enabled():
         return fallback
+    state = _gist_state(gist_for_file(filename))
+    with state["lock"]:
+        if filename in state["dirty"]:
+            data = state["dirty"][filename]
+            if data is _GIST_DELETED:
+                return fallback
+            return _clone_json(data) if copy else data
     try:
-        r = requests.get(GIST_URL, headers=GIST_HEADERS, timeout=20)
-        gist = r.json()
-        files = gist.get("files", {})
-        content = files.get(filename, {}).get("content")
-        if content is None:
-            return fallback
-        return _safe_json_load(content, fallback)
+        files = _fetch_gist_snapshot(state)
     except Exception as e:
         print(f"GIST READ ERR ({filename}): {e}")
         return fallback
+    data = files.get(filename, _NO_DATA)
+    if data is _NO_DATA:
+        return fallback
+    return _clone_json(data) if copy else data
+
+
+def _flush_gist_state(state: Dict[str, Any]) -> bool:
+    with state["flush_lock"]:
+        with state["lock"]:
+            if not state["dirty"]:
+                return True
+            batch = dict(state["dirty"])
+            state["dirty"].clear()
+        known_hashes = state["hashes"]
+        # Xoá file chỉ cần khi gist còn giữ file đó
+        deletions = [filename for filename, data in batch.items()
+                     if data is _GIST_DELETED and filename in known_hashes]
+        contents = {filename: _encode_gist_file(data) for filename, data in batch.items() if data is not _GIST_DELETED}
+        # Bỏ qua file có nội dung trùng với bản đang nằm trên gist
+        digests = {filename: _content_hash(content) for filename, content in contents.items()}
+        unchanged = [filename for filename, digest in digests.items() if known_hashes.get(filename) == digest]
+        for filename in unchanged:
+            contents.pop(filename)
+        # Gist không phục vụ lại được file lớn hơn giới hạn, ghi lên sẽ không đọc về được nữa
+        oversized = [filename for filename, content in contents.items()
+                     if len(content.encode("utf-8")) > GIST_MAX_FILE_BYTES]
+        for filename in oversized:
+            contents.pop(filename)
+            print(f"GIST WRITE ERR ({filename}): larger than {GIST_MAX_FILE_BYTES} bytes, not written")
+        with state["lock"]:
+            GIST_STATS["writes_skipped"] += len(unchanged)
+            GIST_STATS["writes_rejected"] += len(oversized)
+        if not contents and not deletions:
+            if oversized:
+                _discard_rejected_files(state, oversized)
+            return not oversized
+        payload = {"files": {filename: {"content": content} for filename, content in contents.items()}}
+        payload["files"].update({filename: None for filename in deletions})
+        ok = False
+        try:
+            r = http_request("github", "PATCH", state["url"], headers=GIST_HEADERS, json=payload)
+            ok = r.ok
+            if not ok:
+                print(f"GIST WRITE ERR ({', '.join(batch)}): HTTP {r.status_code}")
+        except Exception as e:
+            print(f"GIST WRITE ERR ({', '.join(batch)}): {e}")
+        with state["lock"]:
+            if not ok:
+                GIST_STATS["flush_errors"] += 1
+                # Trả lại hàng đợi để lần flush sau ghi tiếp, trừ khi đã có bản mới hơn
+                for filename in list(contents) + deletions:
+                    state["dirty"].setdefault(filename, batch[filename])
+            else:
+                hashes = dict(state["hashes"])
+                for filename in contents:
+                    hashes[filename] = digests[filename]
+                for filename in deletions:
+                    hashes.pop(filename, None)
+                state["hashes"] = hashes
+                GIST_STATS["flushes"] += 1
+                GIST_STATS["files_flushed"] += len(contents)
+                GIST_STATS["writes_performed"] += len(contents)
+        if oversized:
+            _discard_rejected_files(state, oversized)
+        return ok and not oversized
+
+
+def _discard_rejected_files(state: Dict[str, Any], filenames: List[str]) -> None:
+    # Bản bị từ chối không lên gist: tải lại bản đang nằm trên gist để cache không giữ dữ liệu chưa lưu
+    with state["lock"]:
+        hashes = dict(state["hashes"])
+        raw_urls = dict(state["raw_urls"])
+        for filename in filenames:
+            hashes.pop(filename, None)
+            raw_urls.pop(filename, None)
+        state["hashes"] = hashes
+        state["raw_urls"] = raw_urls
+        state["etag"] = ""
+        state["fetched_at"] = 0.0
+    try:
+        _fetch_gist_snapshot(state, force=True)
+    except Exception as e:
+        print(f"GIST READ ERR ({', '.join(filenames)}): {e}")
+    with state["lock"]:
+        if state["fetched_at"]:
+            return
+        # Không tải lại được: bỏ bản trong cache và coi file là chưa đọc được tới lần tải thành công sau
+        for filename in filenames:
+            if filename not in state["dirty"]:
+                state["unreadable"].add(filename)
+                _cache_gist_file(state, filename, _GIST_DELETED)
 
 
-def save_gist_json(filename: str, data: Any) -> None:
+def flush_gist_writes() -> bool:
     if not gist_enabled():
-        return
-    try:
-        payload = {
-            "files": {
-                filename: {
-                    "content": json.dumps(data, indent=2, ensure_ascii=False)
-                }
+        return True
+    states = [state for state in list(_GIST_STATES.values()) if state["dirty"]]
+    if not states:
+        return True
+    if len(states) == 1:
+        return _flush_gist_state(states[0])
+    # Mỗi gist 1 PATCH, các gist ghi song song
+    return all(list(_GIST_POOL.map(_flush_gist_state, states)))
+
+
+def _gist_flush_worker() -> None:
+    while True:
+        time.sleep(GIST_FLUSH_INTERVAL)
+        try:
+            flush_gist_writes()
+        except Exception as e:
+            print(f"GIST FLUSH ERR: {e}")
+
+
+def _ensure_gist_flush_worker() -> None:
+    global _GIST_FLUSH_THREAD
+    with _GIST_STATES_LOCK:
+        if _GIST_FLUSH_THREAD is None or not _GIST_FLUSH_THREAD.is_alive():
+            _GIST_FLUSH_THREAD = threading.Thread(target=_gist_flush_worker, name="gist-flush", daemon=True)
+            _GIST_FLUSH_THREAD.start()
+
+
+def delete_gist_file(state: Dict[str, Any], filename: str) -> None:
+    # Xoá file khỏi 1 gist cụ thể (không theo GIST_ROUTES), ghi cùng lần flush kế tiếp
+    with state["lock"]:
+        state["dirty"][filename] = _GIST_DELETED
+        _cache_gist_file(state, filename, _GIST_DELETED)
+    if GIST_FLUSH_INTERVAL <= 0:
+        flush_gist_writes()
+    else:
+        _ensure_gist_flush_worker()
+
+
+def save_gist_json(filename: str, data: Any) -> bool:
+    if not gist_enabled():
+        return True
+    state = _gist_state(gist_for_file(filename))
+    with state["lock"]:
+        if filename in state["unreadable"]:
+            GIST_STATS["writes_refused"] += 1
+            print(f"GIST WRITE REFUSED ({filename}): file on gist could not be read")
+            return False
+    snapshot = _clone_json(data)
+    with state["lock"]:
+        state["dirty"][filename] = snapshot
+        _cache_gist_file(state, filename, snapshot)
+    if GIST_FLUSH_INTERVAL <= 0:
+        return flush_gist_writes()
+    # Ghi sau: file bị từ chối thì flush kế tiếp (storage_flush) trả về False
+    _ensure_gist_flush_worker()
+    return True
+
+
+def _gist_journal_name(txn_id: str) -> str:
+    return f"{GIST_JOURNAL_PREFIX}{txn_id}.json"
+
+
+def _restore_gist_files(state: Dict[str, Any], previous: Dict[str, Tuple[Any, Any]]) -> None:
+    # Trả hàng ghi và cache về như trước lần ghi không thành công
+    with state["lock"]:
+        for filename, (old_dirty, old_file) in previous.items():
+            if old_dirty is _NO_DATA:
+                state["dirty"].pop(filename, None)
+            else:
+                state["dirty"][filename] = old_dirty
+            _cache_gist_file(state, filename, _GIST_DELETED if old_file is _NO_DATA else old_file)
+
+
+def save_gist_files(files: Dict[str, Any], txn_id: str = "") -> bool:
+    # Ghi nhiều file ngay lập tức: mỗi gist đúng 1 PATCH chứa mọi file của lần ghi này.
+    # True: đã ghi xong, hoặc đã ghi journal và phần còn lại đang chờ ghi tiếp.
+    # False: không ghi được, hàng ghi và cache đã được trả về như cũ.
+    if not gist_enabled():
+        return True
+    batches: Dict[str, Tuple[Dict[str, Any], Dict[str, Any]]] = {}
+    for filename, data in files.items():
+        state = _gist_state(gist_for_file(filename))
+        batches.setdefault(state["id"], (state, {}))[1][filename] = data
+    for state, batch in batches.values():
+        with state["lock"]:
+            refused = [filename for filename in batch if filename in state["unreadable"]]
+        if refused:
+            GIST_STATS["writes_refused"] += len(refused)
+            print(f"GIST WRITE REFUSED ({', '.join(refused)}): file on gist could not be read")
+            return False
+
+    contents = {filename: _encode_gist_file(data) for filename, data in files.items()}
+    leader = None
+    journal = ""
+    if txn_id and len(batches) > 1:
+        # Nhiều gist thì không có 1 PATCH nguyên tử: gist chính ghi trước, kèm journal chứa phần thay đổi
+        # dành cho các gist còn lại; process chết giữa chừng thì lúc khởi động ghi nốt (GistStorage.recover).
+        # Journal chỉ giữ các key cấp 1 bị sửa/xoá so với bản đang nằm trên gist, không chép cả file.
+        leader = _gist_state(GIST_ID)
+        journal = _gist_journal_name(txn_id)
+        entry: Dict[str, Any] = {"id": txn_id, "created_at": now_ts(), "files": {}}
+        for state, batch in batches.values():
+            if state is leader:
+                continue
+            with state["lock"]:
+                hashes = state["hashes"]
+                cached = state["files"] or {}
+                queued = set(state["dirty"])
+            for filename, data in batch.items():
+                item: Dict[str, Any] = {"before": hashes.get(filename), "after": _content_hash(contents[filename])}
+                current = cached.get(filename, _NO_DATA)
+                # Bản trong cache chỉ trùng bản trên gist khi file có trên gist và không còn chờ ghi
+                if isinstance(data, dict) and isinstance(current, dict) and filename in hashes and filename not in queued:
+                    item["set"] = {key: value for key, value in data.items() if current.get(key, _NO_DATA) != value}
+                    item["removed"] = [key for key in current if key not in data]
+                else:
+                    item["data"] = data
+                entry["files"][filename] = item
+        batches.setdefault(leader["id"], (leader, {}))[1][journal] = entry
+        contents[journal] = _encode_gist_file(entry)
+    # Kiểm tra giới hạn cho cả lần ghi trước khi xếp hàng: bỏ 1 file lúc flush thì transaction chỉ ghi được 1 nửa
+    oversized = [filename for filename, content in contents.items() if len(content.encode("utf-8")) > GIST_MAX_FILE_BYTES]
+    if oversized:
+        GIST_STATS["writes_rejected"] += len(oversized)
+        print(f"GIST WRITE ERR ({', '.join(oversized)}): larger than {GIST_MAX_FILE_BYTES} bytes, nothing written")
+        return False
+
+    previous: Dict[str, Dict[str, Tuple[Any, Any]]] = {}
+    for state, batch in batches.values():
+        snapshots = {filename: _clone_json(data) for filename, data in batch.items()}
+        with state["lock"]:
+            cached = state["files"] or {}
+            previous[state["id"]] = {
+                filename: (state["dirty"].get(filename, _NO_DATA), cached.get(filename, _NO_DATA))
+                for filename in snapshots
             }
+            for filename, snapshot in snapshots.items():
+                state["dirty"][filename] = snapshot
+                _cache_gist_file(state, filename, snapshot)
+
+    if leader is not None and not _flush_gist_state(leader):
+        for state, _ in batches.values():
+            _restore_gist_files(state, previous[state["id"]])
+        return False
+    states = [state for state, _ in batches.values() if state is not leader]
+    if len(states) == 1:
+        results = [_flush_gist_state(states[0])]
+    else:
+        results = list(_GIST_POOL.map(_flush_gist_state, states))
+    failed = [state for state, ok in zip(states, results) if not ok]
+    if not failed:
+        if journal:
+            delete_gist_file(leader, journal)
+        return True
+    if journal:
+        # Phần đã ghi không rút lại được: giữ phần còn lại trong hàng ghi để flush sau ghi tiếp
+        print(f"GIST WRITE PARTIAL ({txn_id}): gist {', '.join(state['id'] for state in failed)} "
+              "will be retried, journal kept in the primary gist")
+        return True
+    for state in failed:
+        _restore_gist_files(state, previous[state["id"]])
+    return False
+
+
+# ============================================================
+# STORAGE BACKENDS
+# ============================================================
+class StorageBackend:
+    name = "base"
+
+    def load(self, filename: str, fallback: Any, copy: bool = True) -> Any:
+        raise NotImplementedError
+
+    def save(self, filename: str, data: Any) -> bool:
+        # False = bản này không được lưu (storage từ chối hoặc ghi lỗi); True cả khi đang chờ ghi
+        raise NotImplementedError
+
+    def flush(self) -> bool:
+        return True
+
+    def save_many(self, files: Dict[str, Any], txn_id: str = "") -> bool:
+        # Ghi cùng lúc nhiều file cho storage_transaction; False = không file nào được ghi
+        for filename, data in files.items():
+            self.save(filename, data)
+        return self.flush()
+
+    def recover(self) -> List[str]:
+        # Ghi nốt transaction bị ngắt giữa chừng lần chạy trước, trả về id các transaction đã ghi nốt
+        return []
+
+    def bootstrap(self, defaults: Dict[str, Any]) -> List[str]:
+        created = []
+        for filename, default in defaults.items():
+            if self.load(filename, None) is None:
+                self.save(filename, default)
+                created.append(filename)
+        self.flush()
+        return created
+
+    def prepare(self) -> None:
+        pass
+
+    def generation(self, filename: str) -> int:
+        return 0
+
+    def list_files(self) -> List[str]:
+        return []
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class GistStorage(StorageBackend):
+    name = "gist"
+
+    def load(self, filename: str, fallback: Any, copy: bool = True) -> Any:
+        return load_gist_json(filename, fallback, copy=copy)
+
+    def save(self, filename: str, data: Any) -> bool:
+        return save_gist_json(filename, data)
+
+    def flush(self) -> bool:
+        return flush_gist_writes()
+
+    def save_many(self, files: Dict[str, Any], txn_id: str = "") -> bool:
+        return save_gist_files(files, txn_id=txn_id)
+
+    def recover(self) -> List[str]:
+        # Journal trong gist chính: file chưa được ghi (vẫn là bản "before") thì ghi nốt,
+        # file đã ghi hoặc đã bị sửa tiếp sau transaction thì giữ nguyên
+        if not gist_enabled():
+            return []
+        leader = _gist_state(GIST_ID)
+        try:
+            files = _fetch_gist_snapshot(leader)
+        except Exception as e:
+            print(f"GIST RECOVERY ERR: {e}")
+            return []
+        recovered = []
+        for name in sorted(files):
+            if not name.startswith(GIST_JOURNAL_PREFIX):
+                continue
+            entry = files[name] if isinstance(files[name], dict) else {}
+            txn_id = entry.get("id", name)
+            replay = {}
+            for filename, item in (entry.get("files") or {}).items():
+                state = _gist_state(gist_for_file(filename))
+                try:
+                    _fetch_gist_snapshot(state)
+                except Exception as e:
+                    print(f"GIST READ ERR ({filename}): {e}")
+                with state["lock"]:
+                    current = state["hashes"].get(filename)
+                if current == item.get("after"):
+                    continue
+                if current == item.get("before"):
+                    if "data" in item:
+                        replay[filename] = item["data"]
+                        continue
+                    with state["lock"]:
+                        data = dict((state["files"] or {}).get(filename) or {})
+                    data.update(item.get("set") or {})
+                    for key in item.get("removed") or []:
+                        data.pop(key, None)
+                    replay[filename] = data
+                else:
+                    print(f"GIST RECOVERY SKIP ({txn_id}): {filename} changed after the transaction")
+            if replay and not save_gist_files(replay):
+                print(f"GIST RECOVERY ERR ({txn_id}): journal kept for next start")
+                continue
+            delete_gist_file(leader, name)
+            if replay:
+                recovered.append(txn_id)
+                print(f"Recovered storage transaction {txn_id}: {', '.join(sorted(replay))}")
+        flush_gist_writes()
+        return recovered
+
+    def bootstrap(self, defaults: Dict[str, Any]) -> List[str]:
+        # 1 lần GET cho mỗi gist (tải song song, đồng thời nạp cache), 1 lần PATCH cho mỗi gist thiếu file
+        if not gist_enabled():
+            return []
+        fetched = {state["id"] for state in _fetch_all_gists()}
+        created = []
+        for filename, default in defaults.items():
+            state = _gist_state(gist_for_file(filename))
+            if state["id"] not in fetched:
+                print(f"GIST BOOTSTRAP ERR ({filename}): gist {state['id']} unavailable")
+                continue
+            if (state["files"] or {}).get(filename, _NO_DATA) is _NO_DATA and filename not in state["unreadable"]:
+                save_gist_json(filename, default)
+                created.append(filename)
+        flush_gist_writes()
+        return created
+
+    def prepare(self) -> None:
+        # Vừa thêm route trong GIST_ROUTES: chép file từ gist đang chứa nó sang gist mới,
+        # nếu gist mới chưa có file đó, thay vì để bootstrap tạo file trống
+        if not gist_enabled():
+            return
+        states = _fetch_all_gists()
+        for source in states:
+            for filename, data in list((source["files"] or {}).items()):
+                target = _gist_state(gist_for_file(filename))
+                if target is source or target not in states:
+                    continue
+                if (target["files"] or {}).get(filename, _NO_DATA) is not _NO_DATA or filename in target["unreadable"]:
+                    continue
+                save_gist_json(filename, _clone_json(data))
+                print(f"Copied {filename} from gist {source['id']} to gist {target['id']}")
+        flush_gist_writes()
+        # Bản cũ chỉ xoá khi bản ở gist mới đã ghi xong; để lại thì mỗi lần GET gist cũ
+        # vẫn tải về file lớn không dùng tới
+        for source in states:
+            for filename in list((source["files"] or {}).keys()):
+                target = _gist_state(gist_for_file(filename))
+                if target is source or target not in states:
+                    continue
+                with target["lock"]:
+                    copied = filename in target["hashes"] and filename not in target["dirty"]
+                if copied:
+                    delete_gist_file(source, filename)
+                    print(f"Removed {filename} from gist {source['id']} (now in gist {target['id']})")
+        flush_gist_writes()
+
+    def generation(self, filename: str) -> int:
+        if gist_enabled():
+            try:
+                _fetch_gist_snapshot(_gist_state(gist_for_file(filename)))
+            except Exception as e:
+                print(f"GIST READ ERR ({filename}): {e}")
+        return _GIST_GENERATIONS.get(filename, 0)
+
+    def list_files(self) -> List[str]:
+        if not gist_enabled():
+            return []
+        names = set()
+        for state in _fetch_all_gists():
+            with state["lock"]:
+                names.update(name for name in state["files"] if gist_for_file(name) == state["id"])
+                names.update(name for name, data in state["dirty"].items() if data is not _GIST_DELETED)
+        return sorted(names)
+
+    def stats(self) -> Dict[str, Any]:
+        gists = {
+            state["id"]: {"files": len(state["files"] or {}), "pending_writes": len(state["dirty"])}
+            for state in list(_GIST_STATES.values())
         }
-        requests.patch(GIST_URL, headers=GIST_HEADERS, json=payload, timeout=20)
-    except Exception as e:
-        print(f"GIST WRITE ERR ({filename}): {e}")
-
-
-def ensure_bootstrap_files() -> None:
-    settings = load_gist_json(SETTINGS_FILE, None)
-    if settings is None:
-        save_gist_json(SETTINGS_FILE, default_settings())
-    inventory = load_gist_json(INVENTORY_FILE, None)
-    if inventory is None:
-        save_gist_json(INVENTORY_FILE, default_inventory())
-    for filename, default in [
-        (USERS_FILE, {}),
-        (SECRETS_FILE, {}),
-        (CUSTOMERS_FILE, {}),
-        (ORDERS_FILE, {}),
-        (PENDING_ORDERS_FILE, {}),
-        (PAID_ORDERS_FILE, {}),
-        (REMINDER_LOG_FILE, {}),
-        (FREE_REQUESTS_FILE, {}),
-        (COUPONS_FILE, {}),
-    ]:
-        if load_gist_json(filename, None) is None:
-            save_gist_json(filename, default)
+        return {**GIST_STATS, "gists": gists}
+
+
+def _sqlite_dumps(value: Any) -> str:
+    return json_dumps_text(value)
+
+
+class SQLiteStorage(StorageBackend):
+    # Mỗi file JSON là 1 bảng, mỗi key cấp 1 (user_id, order_code, ...) là 1 dòng,
+    # nên save chỉ ghi những dòng thực sự thay đổi.
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS storage_files ("
+            "filename TEXT PRIMARY KEY, table_name TEXT NOT NULL, kind TEXT NOT NULL, updated_at INTEGER NOT NULL)"
+        )
+        self.rows: Dict[str, Dict[str, str]] = {}
+        self.cache: Dict[str, Any] = {}
+        self.data_version = self._data_version()
+        self.external_changes = 0
+        self.counters = {
+            "reads": 0, "cache_hits": 0, "rows_written": 0, "rows_deleted": 0,
+            "writes_performed": 0, "writes_skipped": 0,
+        }
+
+    def _data_version(self) -> int:
+        return int(self.conn.execute("PRAGMA data_version").fetchone()[0])
+
+    @staticmethod
+    def table_name(filename: str) -> str:
+        base = filename[:-5] if filename.endswith(".json") else filename
+        return "doc_" + re.sub(r"[^0-9A-Za-z_]", "_", base)
+
+    def _check_external_changes(self) -> None:
+        # data_version đổi khi connection khác (process khác) commit
+        version = self._data_version()
+        if version != self.data_version:
+            self.data_version = version
+            self.external_changes += 1
+            self.rows.clear()
+            self.cache.clear()
+
+    def _read(self, filename: str) -> Any:
+        if filename in self.cache:
+            self.counters["cache_hits"] += 1
+            return self.cache[filename]
+        self.counters["reads"] += 1
+        meta = self.conn.execute(
+            "SELECT table_name, kind FROM storage_files WHERE filename = ?", (filename,)
+        ).fetchone()
+        if meta is None:
+            return _NO_DATA
+        table, kind = meta
+        rows = {key: value for key, value in self.conn.execute(f'SELECT key, value FROM "{table}"')}
+        self.rows[filename] = rows
+        if kind == "dict":
+            data = {key: _safe_json_load(value, None) for key, value in rows.items()}
+        else:
+            data = _safe_json_load(rows.get("", "null"), None)
+        self.cache[filename] = data
+        return data
+
+    def load(self, filename: str, fallback: Any, copy: bool = True) -> Any:
+        with self.lock:
+            try:
+                self._check_external_changes()
+                data = self._read(filename)
+            except Exception as e:
+                print(f"SQLITE READ ERR ({filename}): {e}")
+                return fallback
+            if data is _NO_DATA:
+                return fallback
+            return _clone_json(data) if copy else data
+
+    def _plan_write(self, filename: str, data: Any) -> Optional[Dict[str, Any]]:
+        current = self._read(filename)
+        if current is _NO_DATA:
+            self.rows[filename] = {}
+        old_rows = self.rows.get(filename, {})
+        kind = "dict" if isinstance(data, dict) else "value"
+        if kind == "dict":
+            new_rows = {str(key): _sqlite_dumps(value) for key, value in data.items()}
+        else:
+            new_rows = {"": _sqlite_dumps(data)}
+        changed = [(key, value) for key, value in new_rows.items() if old_rows.get(key) != value]
+        removed = [(key,) for key in old_rows if key not in new_rows]
+        if (not changed and not removed and current is not _NO_DATA
+                and isinstance(current, dict) == (kind == "dict")):
+            return None
+        return {"filename": filename, "data": data, "kind": kind, "rows": new_rows,
+                "changed": changed, "removed": removed}
+
+    def _execute_write(self, plan: Dict[str, Any]) -> None:
+        table = self.table_name(plan["filename"])
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.conn.execute(
+            "INSERT INTO storage_files (filename, table_name, kind, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(filename) DO UPDATE SET kind = excluded.kind, updated_at = excluded.updated_at",
+            (plan["filename"], table, plan["kind"], now_ts()),
+        )
+        if plan["changed"]:
+            self.conn.executemany(
+                f'INSERT INTO "{table}" (key, value) VALUES (?, ?) '
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                plan["changed"],
+            )
+        if plan["removed"]:
+            self.conn.executemany(f'DELETE FROM "{table}" WHERE key = ?', plan["removed"])
+
+    def save(self, filename: str, data: Any) -> bool:
+        return self.save_many({filename: data})
+
+    def save_many(self, files: Dict[str, Any], txn_id: str = "") -> bool:
+        # Mọi file trong 1 transaction SQL
+        with self.lock:
+            try:
+                self._check_external_changes()
+                plans = []
+                for filename, data in files.items():
+                    plan = self._plan_write(filename, data)
+                    if plan is None:
+                        self.counters["writes_skipped"] += 1
+                    else:
+                        plans.append(plan)
+                if not plans:
+                    return True
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    for plan in plans:
+                        self._execute_write(plan)
+                    self.conn.execute("COMMIT")
+                except Exception:
+                    self.conn.execute("ROLLBACK")
+                    raise
+                self.data_version = self._data_version()
+                for plan in plans:
+                    self.rows[plan["filename"]] = plan["rows"]
+                    self.cache[plan["filename"]] = _clone_json(plan["data"])
+                    self.counters["writes_performed"] += 1
+                    self.counters["rows_written"] += len(plan["changed"])
+                    self.counters["rows_deleted"] += len(plan["removed"])
+                return True
+            except Exception as e:
+                print(f"SQLITE WRITE ERR ({', '.join(files)}): {e}")
+                return False
+
+    def generation(self, filename: str) -> int:
+        with self.lock:
+            self._check_external_changes()
+            return self.external_changes
+
+    def list_files(self) -> List[str]:
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT filename FROM storage_files ORDER BY filename")]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"path": self.path, **self.counters}
+
+
+_STORAGE: Optional[StorageBackend] = None
+_STORAGE_LOCK = threading.Lock()
+
+
+def get_storage() -> StorageBackend:
+    global _STORAGE
+    if _STORAGE is None:
+        with _STORAGE_LOCK:
+            if _STORAGE is None:
+                if STORAGE_BACKEND == "sqlite":
+                    _STORAGE = SQLiteStorage(SQLITE_PATH)
+                else:
+                    _STORAGE = GistStorage()
+    return _STORAGE
+
+
+# ============================================================
+# SHARDED FILES
+# ============================================================
+# File logic (users.json) được lưu thành các shard users.00.json, users.01.json, ...
+# theo hash của key cấp 1 (user_id); sửa 1 user chỉ ghi lại đúng shard chứa user đó.
+SHARDED_FILES: Dict[str, int] = {USERS_FILE: USERS_SHARDS, CUSTOMERS_FILE: CUSTOMERS_SHARDS}
+SHARD_STATS: Dict[str, int] = {"shards_written": 0, "shards_skipped": 0}
+
+
+def shard_count(filename: str) -> int:
+    return max(1, SHARDED_FILES.get(filename, 1))
+
+
+def shard_filename(filename: str, index: int) -> str:
+    base = filename[:-5] if filename.endswith(".json") else filename
+    return f"{base}.{index:02d}.json"
+
+
+def shard_files(filename: str) -> List[str]:
+    count = shard_count(filename)
+    if count == 1:
+        return [filename]
+    return [shard_filename(filename, idx) for idx in range(count)]
+
+
+def shard_for_key(filename: str, key: Any) -> str:
+    count = shard_count(filename)
+    if count == 1:
+        return filename
+    return shard_filename(filename, zlib.crc32(str(key).encode("utf-8")) % count)
+
+
+def _shard_name_pattern(filename: str) -> "re.Pattern[str]":
+    base = filename[:-5] if filename.endswith(".json") else filename
+    return re.compile(re.escape(base) + r"\.\d+\.json$")
+
+
+def _backend_load(filename: str, fallback: Any, copy: bool = True) -> Any:
+    storage = get_storage()
+    if shard_count(filename) == 1:
+        return storage.load(filename, fallback, copy=copy)
+    merged: Dict[str, Any] = {}
+    found = False
+    for name in shard_files(filename):
+        part = storage.load(name, _NO_DATA, copy=copy)
+        if isinstance(part, dict):
+            found = True
+            merged.update(part)
+    return merged if found else fallback
+
+
+def _physical_files(filename: str, data: Any) -> Dict[str, Any]:
+    # File thật cần ghi cho 1 file logic: chính nó, hoặc các shard có nội dung thay đổi
+    if shard_count(filename) == 1 or not isinstance(data, dict):
+        return {filename: data}
+    storage = get_storage()
+    parts: Dict[str, Dict[str, Any]] = {name: {} for name in shard_files(filename)}
+    for key, value in data.items():
+        parts[shard_for_key(filename, key)][key] = value
+    changed = {}
+    for name, part in parts.items():
+        # So sánh dict rẻ hơn nhiều so với serialize, shard không đổi thì không ghi
+        if storage.load(name, _NO_DATA, copy=False) == part:
+            SHARD_STATS["shards_skipped"] += 1
+            continue
+        changed[name] = part
+        SHARD_STATS["shards_written"] += 1
+    return changed
+
+
+def _backend_save(filename: str, data: Any) -> None:
+    storage = get_storage()
+    for name, part in _physical_files(filename, data).items():
+        storage.save(name, part)
+
+
+def _backend_generation(filename: str) -> int:
+    storage = get_storage()
+    return sum(storage.generation(name) for name in shard_files(filename))
+
+
+def migrate_sharded_file(filename: str) -> Dict[str, Any]:
+    # Gom file gốc và mọi shard cũ (kể cả khi đổi số shard) rồi chia lại theo cấu hình hiện tại.
+    # Shard ghi sau file gốc nên dữ liệu trong shard được ưu tiên.
+    storage = get_storage()
+    pattern = _shard_name_pattern(filename)
+    sources = [filename] + [name for name in storage.list_files() if pattern.match(name)]
+    merged: Dict[str, Any] = {}
+    for name in sources:
+        part = storage.load(name, None)
+        if isinstance(part, dict):
+            merged.update(part)
+    _backend_save(filename, merged)
+    targets = set(shard_files(filename))
+    for name in sources:
+        if name not in targets and storage.load(name, None, copy=False):
+            storage.save(name, {})
+    storage.flush()
+    return {"file": filename, "records": len(merged), "sources": sources, "shards": shard_count(filename)}
+
+
+def _needs_shard_migration(filename: str) -> bool:
+    # Cần chia lại khi file gốc/shard cũ ngoài cấu hình còn dữ liệu, hoặc có key nằm sai shard
+    storage = get_storage()
+    targets = shard_files(filename)
+    pattern = _shard_name_pattern(filename)
+    for name in storage.list_files():
+        if name in targets or not (name == filename or pattern.match(name)):
+            continue
+        if storage.load(name, None, copy=False):
+            return True
+    if len(targets) == 1:
+        return False
+    for name in targets:
+        data = storage.load(name, None, copy=False)
+        if isinstance(data, dict) and any(shard_for_key(filename, key) != name for key in data):
+            return True
+    return False
+
+
+# Mỗi update chạy trong 1 unit of work: mỗi file chỉ load 1 lần rồi dùng lại cùng object,
+# các lần save chỉ đánh dấu file và được ghi 1 lần khi handler chạy xong.
+_UNIT_OF_WORK: "contextvars.ContextVar[Optional[Dict[str, Any]]]" = contextvars.ContextVar("unit_of_work", default=None)
+UOW_STATS: Dict[str, int] = {"units": 0, "loads": 0, "reused": 0, "saves": 0, "committed_files": 0}
+
+# Phiên bản của 1 file logic = (số lần process này ghi file, generation của storage).
+# Handler chạy song song: đọc kèm phiên bản, lúc ghi nếu phiên bản đã đổi thì gộp 3 chiều
+# với bản mới nhất thay vì ghi đè. Mọi lần ghi 1 file đi qua khoá riêng của file đó.
+_FILE_VERSIONS: Dict[str, int] = {}
+_FILE_LOCKS: Dict[str, threading.RLock] = {}
+_FILE_LOCKS_GUARD = threading.Lock()
+CONCURRENCY_STATS: Dict[str, int] = {"cas_commits": 0, "cas_retries": 0, "cas_exhausted": 0,
+                                     "merges": 0, "merge_conflicts": 0}
+
+
+def file_lock(filename: str) -> threading.RLock:
+    lock = _FILE_LOCKS.get(filename)
+    if lock is None:
+        with _FILE_LOCKS_GUARD:
+            lock = _FILE_LOCKS.setdefault(filename, threading.RLock())
+    return lock
+
+
+def storage_version(filename: str) -> Tuple[int, int]:
+    return _FILE_VERSIONS.get(filename, 0), _backend_generation(filename)
+
+
+def merge_documents(base: Any, mine: Any, theirs: Any) -> Any:
+    # Gộp theo key: key mình không sửa giữ bản mới nhất, key chỉ mình sửa lấy bản của mình,
+    # cả 2 cùng sửa 1 dict thì gộp tiếp từng field; sửa trùng 1 giá trị thì bản của mình thắng.
+    if not isinstance(mine, dict) or not isinstance(theirs, dict):
+        return mine
+    if not isinstance(base, dict):
+        base = {}
+    merged = dict(theirs)
+    for key in set(base) | set(mine):
+        old = base.get(key, _NO_DATA)
+        value = mine.get(key, _NO_DATA)
+        if value is old or value == old:
+            continue
+        current = theirs.get(key, _NO_DATA)
+        if current is old or current == old or current == value:
+            pass
+        elif isinstance(value, dict) and isinstance(current, dict):
+            value = merge_documents(old, value, current)
+        else:
+            CONCURRENCY_STATS["merge_conflicts"] += 1
+        if value is _NO_DATA:
+            merged.pop(key, None)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _commit_file(filename: str, data: Any, base: Any = _NO_DATA,
+                 version: Optional[Tuple[int, int]] = None) -> Tuple[int, int]:
+    # version=None: ghi thẳng (không đọc trước); ngược lại chỉ ghi đè khi file chưa đổi từ lúc đọc
+    with file_lock(filename):
+        current = storage_version(filename)
+        if version is not None and version != current:
+            CONCURRENCY_STATS["merges"] += 1
+            data = merge_documents(base, data, _backend_load(filename, _NO_DATA, copy=False))
+        _backend_save(filename, data)
+        _FILE_VERSIONS[filename] = current[0] + 1
+        return current[0] + 1, current[1]
+
+
+def _track_uow_file(uow: Dict[str, Any], filename: str, fallback: Any) -> Any:
+    version = storage_version(filename)
+    base = _backend_load(filename, _NO_DATA, copy=False)
+    data = fallback if base is _NO_DATA else _clone_json(base)
+    uow["files"][filename] = data
+    uow["base"][filename] = (base, version)
+    return data
+
+
+def _refresh_uow_file(uow: Dict[str, Any], filename: str) -> None:
+    # Đồng bộ bản đang sửa với bản vừa ghi, giữ nguyên object để biến handler đang giữ vẫn đúng
+    working = uow["files"][filename]
+    fresh = _track_uow_file(uow, filename, working)
+    if fresh is not working and isinstance(working, dict) and isinstance(fresh, dict):
+        working.clear()
+        working.update(fresh)
+        uow["files"][filename] = working
+    uow["dirty"].pop(filename, None)
+
+
+def _commit_uow_file(uow: Dict[str, Any], filename: str) -> None:
+    base, version = uow["base"].get(filename, (_NO_DATA, None))
+    _commit_file(filename, uow["files"][filename], base, version)
+    UOW_STATS["committed_files"] += 1
+
+
+@contextlib.contextmanager
+def unit_of_work():
+    if _UNIT_OF_WORK.get() is not None:
+        yield
+        return
+    uow: Dict[str, Any] = {"files": {}, "dirty": {}, "base": {}, "txn": None}
+    token = _UNIT_OF_WORK.set(uow)
+    UOW_STATS["units"] += 1
+    try:
+        yield
+    finally:
+        _UNIT_OF_WORK.reset(token)
+        # Ghi cả khi handler lỗi giữa chừng, giống như khi mỗi lần save được ghi ngay
+        commit_unit_of_work(uow)
+
+
+def commit_unit_of_work(uow: Dict[str, Any]) -> None:
+    for filename in list(uow["dirty"]):
+        _commit_uow_file(uow, filename)
+    uow["dirty"].clear()
+
+
+def storage_load(filename: str, fallback: Any) -> Any:
+    uow = _UNIT_OF_WORK.get()
+    if uow is None:
+        return _backend_load(filename, fallback)
+    files = uow["files"]
+    if filename in files:
+        UOW_STATS["reused"] += 1
+        return files[filename]
+    UOW_STATS["loads"] += 1
+    return _track_uow_file(uow, filename, fallback)
+
+
+def storage_read_only(filename: str, fallback: Any) -> Any:
+    # Trả về bản dùng chung trong cache, không copy: người gọi không được sửa dữ liệu
+    uow = _UNIT_OF_WORK.get()
+    if uow is not None and filename in uow["files"]:
+        UOW_STATS["reused"] += 1
+        return uow["files"][filename]
+    return _backend_load(filename, fallback, copy=False)
+
+
+def storage_read_item(filename: str, key: str, default: Any = None) -> Any:
+    # Đọc 1 key cấp 1 mà không phải gộp mọi shard; không được sửa giá trị trả về
+    uow = _UNIT_OF_WORK.get()
+    if uow is not None and filename in uow["files"]:
+        return uow["files"][filename].get(key, default)
+    data = get_storage().load(shard_for_key(filename, key), {}, copy=False)
+    return data.get(key, default) if isinstance(data, dict) else default
+
+
+def storage_save(filename: str, data: Any) -> None:
+    uow = _UNIT_OF_WORK.get()
+    if uow is None:
+        _commit_file(filename, data)
+        return
+    uow["files"][filename] = data
+    uow["dirty"][filename] = True
+    UOW_STATS["saves"] += 1
+
+
+def storage_update(filename: str, fallback: Any, mutator: Callable[[Any], Any]) -> Any:
+    # Đọc-sửa-ghi nguyên tử cho 1 file: mutator sửa trực tiếp bản copy được truyền vào và có thể
+    # bị gọi lại nhiều lần, nên không được gửi tin nhắn hay đụng file khác bên trong.
+    # Khoá file chặn các thread khác trong process; nếu file đổi từ bên ngoài (generation tăng)
+    # trong lúc sửa thì đọc lại và chạy lại mutator.
+    uow = _UNIT_OF_WORK.get()
+    if uow is not None and uow.get("txn") is not None:
+        return _txn_update(uow, filename, fallback, mutator)
+    with file_lock(filename):
+        if uow is not None and filename in uow["dirty"]:
+            # Ghi trước phần handler đã sửa để mutator thấy được
+            _commit_uow_file(uow, filename)
+        attempts = max(1, STORAGE_CAS_ATTEMPTS)
+        for attempt in range(attempts):
+            version = storage_version(filename)
+            data = _backend_load(filename, _NO_DATA)
+            if data is _NO_DATA:
+                data = _clone_json(fallback)
+            result = mutator(data)
+            if storage_version(filename) == version:
+                break
+            CONCURRENCY_STATS["cas_retries"] += 1
+        else:
+            CONCURRENCY_STATS["cas_exhausted"] += 1
+            print(f"STORAGE CAS EXHAUSTED ({filename}): ghi đè sau {attempts} lần thử")
+        _backend_save(filename, data)
+        _FILE_VERSIONS[filename] = version[0] + 1
+        CONCURRENCY_STATS["cas_commits"] += 1
+        if uow is not None and filename in uow["files"]:
+            _refresh_uow_file(uow, filename)
+    return result
+
+
+def storage_flush() -> bool:
+    uow = _UNIT_OF_WORK.get()
+    if uow is not None and uow.get("txn") is None:
+        # Flush giữa handler: ghi luôn các file đã sửa rồi mới đẩy lên storage
+        for filename in list(uow["dirty"]):
+            with file_lock(filename):
+                _commit_uow_file(uow, filename)
+                _refresh_uow_file(uow, filename)
+    return get_storage().flush()
+
+
+def storage_generation(filename: str) -> int:
+    # Chỉ số dựng từ 1 file phải dựng lại khi generation của file đó đổi
+    return _backend_generation(filename)
+
+
+# storage_transaction gom thay đổi của nhiều file rồi ghi 1 lần: mỗi gist 1 PATCH, SQLite 1 transaction.
+# Ghi nhiều gist thì gist chính giữ journal để ghi nốt khi khởi động lại (xem save_gist_files).
+# Không ghi được thì transaction bị huỷ và lỗi được ném ra cho người gọi.
+TXN_STATS: Dict[str, int] = {"transactions": 0, "files_committed": 0, "rollbacks": 0,
+                             "commit_errors": 0, "recovered": 0}
+_TXN_IDS = itertools.count(1)
+
+
+def _rebase_uow_file(uow: Dict[str, Any], filename: str) -> None:
+    # File đã đổi từ lúc handler đọc: gộp phần handler đang sửa lên bản mới nhất
+    base, version = uow["base"].get(filename, (_NO_DATA, None))
+    if version is None or version == storage_version(filename):
+        return
+    if filename not in uow["dirty"]:
+        _refresh_uow_file(uow, filename)
+        return
+    working = uow["files"][filename]
+    latest = _backend_load(filename, _NO_DATA, copy=False)
+    merged = _clone_json(merge_documents(base, working, latest))
+    _track_uow_file(uow, filename, None)
+    if isinstance(working, dict) and isinstance(merged, dict):
+        working.clear()
+        working.update(merged)
+        merged = working
+    uow["files"][filename] = merged
+
+
+def _txn_update(uow: Dict[str, Any], filename: str, fallback: Any, mutator: Callable[[Any], Any]) -> Any:
+    # Trong transaction: giữ khoá file tới lúc commit, sửa trên bản của unit of work.
+    # Các file được khoá theo thứ tự gọi, nên mọi transaction cần gọi storage_update theo cùng thứ tự.
+    txn = uow["txn"]
+    lock = file_lock(filename)
+    lock.acquire()
+    txn["locks"].append(lock)
+    if filename in uow["files"]:
+        _rebase_uow_file(uow, filename)
+    data = storage_load(filename, _clone_json(fallback))
+    result = mutator(data)
+    storage_save(filename, data)
+    return result
+
+
+def _commit_transaction(uow: Dict[str, Any], txn: Dict[str, Any]) -> None:
+    filenames = sorted(uow["dirty"])
+    if not filenames:
+        return
+    storage = get_storage()
+    with contextlib.ExitStack() as stack:
+        for filename in filenames:
+            stack.enter_context(file_lock(filename))
+        physical: Dict[str, Any] = {}
+        versions = {}
+        for filename in filenames:
+            base, version = uow["base"].get(filename, (_NO_DATA, None))
+            current = storage_version(filename)
+            data = uow["files"][filename]
+            if version is not None and version != current:
+                CONCURRENCY_STATS["merges"] += 1
+                data = merge_documents(base, data, _backend_load(filename, _NO_DATA, copy=False))
+            physical.update(_physical_files(filename, data))
+            versions[filename] = current
+        if physical and not storage.save_many(physical, txn_id=txn["id"]):
+            # storage_transaction huỷ các thay đổi trong unit of work rồi ném lỗi tiếp
+            TXN_STATS["commit_errors"] += 1
+            raise RuntimeError("storage_commit_failed")
+        for filename, current in versions.items():
+            _FILE_VERSIONS[filename] = current[0] + 1
+        uow["dirty"].clear()
+    TXN_STATS["transactions"] += 1
+    TXN_STATS["files_committed"] += len(physical)
+
+
+def storage_after_commit(callback: Callable[[], None]) -> None:
+    # Cập nhật chỉ số trong bộ nhớ theo thay đổi vừa ghi; trong transaction thì đợi commit xong,
+    # transaction bị huỷ thì bỏ luôn để chỉ số không lệch với dữ liệu
+    uow = _UNIT_OF_WORK.get()
+    txn = uow.get("txn") if uow is not None else None
+    if txn is None:
+        callback()
+        return
+    txn["after_commit"].append(callback)
+
+
+@contextlib.contextmanager
+def storage_transaction():
+    # Mọi thay đổi storage trong khối with được ghi cùng nhau khi khối kết thúc, hoặc bỏ hết nếu
+    # có lỗi. Lồng nhau thì gộp vào transaction ngoài cùng.
+    uow = _UNIT_OF_WORK.get()
+    if uow is not None and uow.get("txn") is not None:
+        yield
+        return
+    with unit_of_work():
+        uow = _UNIT_OF_WORK.get()
+        # Phần handler đã sửa trước transaction được ghi riêng, rollback không đụng tới
+        for filename in list(uow["dirty"]):
+            with file_lock(filename):
+                _commit_uow_file(uow, filename)
+                _refresh_uow_file(uow, filename)
+        txn = {"id": f"txn-{int(time.time() * 1000)}-{next(_TXN_IDS)}", "locks": [], "after_commit": []}
+        uow["txn"] = txn
+        try:
+            yield
+            _commit_transaction(uow, txn)
+        except BaseException:
+            TXN_STATS["rollbacks"] += 1
+            for filename in list(uow["dirty"]):
+                _refresh_uow_file(uow, filename)
+            raise
+        finally:
+            uow["txn"] = None
+            for lock in reversed(txn["locks"]):
+                lock.release()
+        for callback in txn["after_commit"]:
+            callback()
+
+
+# Khoá chung cho các chỉ số trong bộ nhớ dựng từ dữ liệu storage
+_INDEX_LOCK = threading.RLock()
+
+
+def bootstrap_defaults() -> Dict[str, Any]:
+    return {
+        SETTINGS_FILE: default_settings(),
+        INVENTORY_FILE: default_inventory(),
+        USERS_FILE: {},
+        SECRETS_FILE: {},
+        CUSTOMERS_FILE: {},
+        ORDERS_FILE: {},
+        PENDING_ORDERS_FILE: {},
+        PAID_ORDERS_FILE: {},
+        REMINDER_LOG_FILE: {},
+        FREE_REQUESTS_FILE: {},
+        COUPONS_FILE: {},
+        BROADCASTS_FILE: {},
+        BROADCAST_PROGRESS_FILE: {},
+    }
+
+
+def ensure_bootstrap_files() -> List[str]:
+    get_storage().prepare()
+    # Trước khi chia lại shard: journal ghi theo tên file thật lúc transaction chạy
+    TXN_STATS["recovered"] += len(get_storage().recover())
+    # Đổi số shard (hoặc bật shard lần đầu) thì tự chia lại dữ liệu trước khi tạo file trống
+    for filename in SHARDED_FILES:
+        if _needs_shard_migration(filename):
+            result = migrate_sharded_file(filename)
+            print(f"Migrated {filename}: {result['records']} records -> {result['shards']} shard(s)")
+    defaults: Dict[str, Any] = {}
+    for filename, default in bootstrap_defaults().items():
+        for name in shard_files(filename):
+            defaults[name] = default if name == filename else {}
+    return get_storage().bootstrap(defaults)
 
 
 # ============================================================
 # USER / REFERRAL / FREE HELPERS
 # ============================================================
 def get_users() -> Dict[str, Any]:
-    return load_gist_json(USERS_FILE, {})
+    return storage_load(USERS_FILE, {})
 
 
 def save_users(data: Dict[str, Any]):
-    save_gist_json(USERS_FILE, data)
+    storage_save(USERS_FILE, data)
 
 
 def default_user_record(user_id: int, username: str = "", full_name: str = "") -> Dict[str, Any]:
@@ -281,9 +1773,40 @@ def default_user_record(user_id: int, username: str = "", full_name: str = "") -
     }
 
 
+_USER_RECORD_DEFAULT_KEYS = (
+    "points", "used_points", "total_invited", "invited_user_ids",
+    "referral_code", "referred_by", "canva_newbie_claimed", "joined_at",
+)
+
+# Lần tương tác gần nhất của user chỉ giữ trong bộ nhớ, định kỳ mới ghi vào updated_at
+_USER_SEEN: Dict[str, int] = {}
+_USER_SEEN_LOCK = threading.Lock()
+_USER_SEEN_STATE = {"flushed_at": time.time()}
+USER_WRITE_STATS: Dict[str, int] = {"skipped": 0, "written": 0, "seen_flushes": 0}
+
+
+def _user_record_changed(record: Optional[Dict[str, Any]], username: str, full_name: str) -> bool:
+    if not record:
+        return True
+    if any(k not in record for k in _USER_RECORD_DEFAULT_KEYS):
+        return True
+    if username and record.get("username") != username:
+        return True
+    if full_name and record.get("full_name") != full_name:
+        return True
+    return False
+
+
 def ensure_user_record(user_id: int, username: str = "", full_name: str = "") -> Dict[str, Any]:
-    users = get_users()
     key = str(user_id)
+    current = storage_read_item(USERS_FILE, key)
+    if not _user_record_changed(current, username, full_name):
+        with _USER_SEEN_LOCK:
+            _USER_SEEN[key] = now_ts()
+        USER_WRITE_STATS["skipped"] += 1
+        return _clone_json(current)
+
+    users = get_users()
     record = users.get(key) or default_user_record(user_id, username, full_name)
     record.setdefault("points", 0)
     record.setdefault("used_points", 0)
@@ -298,19 +1821,50 @@ def ensure_user_record(user_id: int, username: str = "", full_name: str = "") ->
     record.setdefault("joined_at", now_ts())
     users[key] = record
     save_users(users)
+    _index_referral_code(key, record["referral_code"])
+    with _USER_SEEN_LOCK:
+        _USER_SEEN.pop(key, None)
+    USER_WRITE_STATS["written"] += 1
     return record
 
 
-def update_user_points(user_id: int, delta_points: int = 0, delta_used_points: int = 0) -> Dict[str, Any]:
+def _apply_user_last_seen(pending: Dict[str, int]) -> None:
     users = get_users()
+    changed = False
+    for key, seen_at in pending.items():
+        record = users.get(key)
+        if record and seen_at > int(record.get("updated_at") or 0):
+            record["updated_at"] = seen_at
+            changed = True
+    if changed:
+        save_users(users)
+
+
+def flush_user_last_seen(force: bool = False) -> None:
+    with _USER_SEEN_LOCK:
+        if not _USER_SEEN:
+            return
+        if not force and time.time() - _USER_SEEN_STATE["flushed_at"] < USER_SEEN_FLUSH_INTERVAL:
+            return
+        pending = dict(_USER_SEEN)
+        _USER_SEEN.clear()
+        _USER_SEEN_STATE["flushed_at"] = time.time()
+    run_handler(_apply_user_last_seen, pending)
+    USER_WRITE_STATS["seen_flushes"] += 1
+
+
+def update_user_points(user_id: int, delta_points: int = 0, delta_used_points: int = 0) -> Dict[str, Any]:
     key = str(user_id)
-    record = users.get(key) or default_user_record(user_id)
-    record["points"] = max(0, int(record.get("points", 0)) + int(delta_points))
-    record["used_points"] = max(0, int(record.get("used_points", 0)) + int(delta_used_points))
-    record["updated_at"] = now_ts()
-    users[key] = record
-    save_users(users)
-    return record
+
+    def apply(users: Dict[str, Any]) -> Dict[str, Any]:
+        record = users.get(key) or default_user_record(user_id)
+        record["points"] = max(0, int(record.get("points", 0)) + int(delta_points))
+        record["used_points"] = max(0, int(record.get("used_points", 0)) + int(delta_used_points))
+        record["updated_at"] = now_ts()
+        users[key] = record
+        return dict(record)
+
+    return storage_update(USERS_FILE, {}, apply)
 
 
 def get_user_record(user_id: int) -> Dict[str, Any]:
@@ -318,58 +1872,71 @@ def get_user_record(user_id: int) -> Dict[str, Any]:
     return users.get(str(user_id)) or default_user_record(user_id)
 
 
+# referral_code -> user_id, dựng 1 lần từ users.json; ensure_user_record thêm mã của user vừa lưu
+_REFERRAL_INDEX: Dict[str, Any] = {"generation": None, "codes": {}}
+
+
+def _index_referral_code(uid: str, code: str) -> None:
+    try:
+        user_id = int(uid)
+    except Exception:
+        return
+    with _INDEX_LOCK:
+        _REFERRAL_INDEX["codes"].setdefault(code, user_id)
+
+
+def _referral_index() -> Dict[str, int]:
+    with _INDEX_LOCK:
+        generation = storage_generation(USERS_FILE)
+        if _REFERRAL_INDEX["generation"] != generation:
+            _REFERRAL_INDEX["codes"] = {}
+            for uid, info in get_users().items():
+                code = info.get("referral_code")
+                if code:
+                    _index_referral_code(uid, code)
+            _REFERRAL_INDEX["generation"] = generation
+        return _REFERRAL_INDEX["codes"]
+
+
 def find_user_by_referral_code(ref_code: str) -> Optional[int]:
-    for uid, info in get_users().items():
-        if info.get("referral_code") == ref_code:
-            try:
-                return int(uid)
-            except Exception:
-                return None
-    return None
+    return _referral_index().get(ref_code)
 
 
 def apply_referral_if_needed(user_id: int, username: str, full_name: str, ref_code: str) -> bool:
-    users = get_users()
     key = str(user_id)
-    record = users.get(key) or default_user_record(user_id, username, full_name)
-    if record.get("referred_by"):
-        users[key] = record
-        save_users(users)
-        return False
-
     inviter_id = find_user_by_referral_code(ref_code)
-    if not inviter_id or inviter_id == user_id:
-        users[key] = record
-        save_users(users)
-        return False
 
-    inviter_key = str(inviter_id)
-    inviter = users.get(inviter_key) or default_user_record(inviter_id)
-    invited_ids = inviter.get("invited_user_ids", [])
-    if user_id in invited_ids:
-        record["referred_by"] = inviter_id
+    # Cộng điểm cho người mời trong 1 lần ghi nguyên tử; trả về điểm mới nếu được cộng
+    def apply(users: Dict[str, Any]) -> Optional[int]:
+        record = users.get(key) or default_user_record(user_id, username, full_name)
         users[key] = record
+        if record.get("referred_by") or not inviter_id or inviter_id == user_id:
+            return None
+
+        inviter_key = str(inviter_id)
+        inviter = users.get(inviter_key) or default_user_record(inviter_id)
         users[inviter_key] = inviter
-        save_users(users)
+        invited_ids = inviter.get("invited_user_ids", [])
+        record["referred_by"] = inviter_id
+        if user_id in invited_ids:
+            return None
+
+        invited_ids.append(user_id)
+        inviter["invited_user_ids"] = invited_ids
+        inviter["total_invited"] = len(invited_ids)
+        inviter["points"] = int(inviter.get("points", 0)) + 1
+        inviter["updated_at"] = now_ts()
+        record["updated_at"] = now_ts()
+        return inviter["points"]
+
+    inviter_points = storage_update(USERS_FILE, {}, apply)
+    if inviter_points is None:
         return False
 
-    invited_ids.append(user_id)
-    inviter["invited_user_ids"] = invited_ids
-    inviter["total_invited"] = len(invited_ids)
-    inviter["points"] = int(inviter.get("points", 0)) + 1
-    inviter["updated_at"] = now_ts()
-
-    record["referred_by"] = inviter_id
-    record["updated_at"] = now_ts()
-
-    users[key] = record
-    users[inviter_key] = inviter
-    save_users(users)
-
     tg_send_message(inviter_id,
                     "🎉 Bạn vừa mời thành công 1 người mới.\n"
                     f"+1 điểm đã được cộng.\n"
-                    f"Điểm hiện có: {inviter['points']}")
+                    f"Điểm hiện có: {inviter_points}")
     return True
 
 
@@ -378,7 +1945,7 @@ def get_bot_username() -> str:
     if BOT_USERNAME_CACHE:
         return BOT_USERNAME_CACHE
     try:
-        r = requests.get(f"{TG_BASE_URL}/getMe", timeout=20)
+        r = http_request("telegram", "GET", f"{TG_BASE_URL}/getMe")
         data = r.json()
         if data.get("ok") and data.get("result", {}).get("username"):
             BOT_USERNAME_CACHE = data["result"]["username"]
@@ -398,11 +1965,11 @@ def build_referral_link(user_id: int) -> str:
 
 
 def get_free_requests() -> Dict[str, Any]:
-    return load_gist_json(FREE_REQUESTS_FILE, {})
+    return storage_load(FREE_REQUESTS_FILE, {})
 
 
 def save_free_requests(data: Dict[str, Any]):
-    save_gist_json(FREE_REQUESTS_FILE, data)
+    storage_save(FREE_REQUESTS_FILE, data)
 
 
 def make_free_request_code(gift_code: str, user_id: int) -> str:
@@ -444,6 +2011,8 @@ def mark_canva_claimed(user_id: int):
     record["updated_at"] = now_ts()
     users[key] = record
     save_users(users)
+    if record.get("referral_code"):
+        _index_referral_code(key, record["referral_code"])
 
 
 def refund_points_for_request(req: Dict[str, Any]):
@@ -495,11 +2064,11 @@ def account_summary_text(user_id: int) -> str:
 # COUPON HELPERS
 # ============================================================
 def get_coupons() -> Dict[str, Any]:
-    return load_gist_json(COUPONS_FILE, {})
+    return storage_load(COUPONS_FILE, {})
 
 
 def save_coupons(data: Dict[str, Any]):
-    save_gist_json(COUPONS_FILE, data)
+    storage_save(COUPONS_FILE, data)
 
 
 def normalize_coupon_code(code: str) -> str:
@@ -570,19 +2139,21 @@ def validate_coupon_for_user(coupon_code: str, user_id: int, product_code: str,
 
 
 def apply_coupon_usage(coupon_code: str, user_id: int) -> None:
-    coupons = get_coupons()
     code = normalize_coupon_code(coupon_code)
-    coupon = coupons.get(code)
-    if not coupon:
-        return
-    coupon["used_total"] = int(coupon.get("used_total", 0) or 0) + 1
-    usage = coupon.get("used_by_users", {}) or {}
     key = coupon_usage_key(user_id)
-    usage[key] = int(usage.get(key, 0) or 0) + 1
-    coupon["used_by_users"] = usage
-    coupon["updated_at"] = now_ts()
-    coupons[code] = coupon
-    save_coupons(coupons)
+
+    def apply(coupons: Dict[str, Any]) -> None:
+        coupon = coupons.get(code)
+        if not coupon:
+            return
+        coupon["used_total"] = int(coupon.get("used_total", 0) or 0) + 1
+        usage = coupon.get("used_by_users", {}) or {}
+        usage[key] = int(usage.get(key, 0) or 0) + 1
+        coupon["used_by_users"] = usage
+        coupon["updated_at"] = now_ts()
+        coupons[code] = coupon
+
+    storage_update(COUPONS_FILE, {}, apply)
 
 
 def create_coupon(code: str, discount_type: str, discount_value: int,
@@ -640,39 +2211,293 @@ def format_coupon_brief(coupon: Dict[str, Any]) -> str:
 # ============================================================
 # TELEGRAM HELPERS
 # ============================================================
-def tg_request(method: str, payload: Dict[str, Any]) -> None:
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = max(0.1, float(rate))
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def pause(self, seconds: float) -> None:
+        # Khi Telegram trả 429 thì dừng cả bucket cho tới hết retry_after
+        with self.lock:
+            resume_at = time.monotonic() + max(0.0, float(seconds))
+            if resume_at > self.updated_at:
+                self.updated_at = resume_at
+                self.tokens = 0.0
+
+    def try_acquire(self) -> float:
+        # Trả 0 nếu lấy được token, ngược lại trả số giây cần chờ
+        with self.lock:
+            now = time.monotonic()
+            if now < self.updated_at:
+                return self.updated_at - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self) -> None:
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+# Giới hạn chung của bot, chừa khoảng trống dưới mức ~30 tin/giây của Telegram
+TG_GLOBAL_BUCKET = TokenBucket(TG_GLOBAL_RATE, capacity=TG_GLOBAL_RATE)
+# Broadcast chỉ dùng một phần giới hạn chung để tin thanh toán/nhắc hạn vẫn đi được
+TG_BROADCAST_BUCKET = TokenBucket(TG_BROADCAST_RATE, capacity=5)
+
+
+def tg_request(method: str, payload: Dict[str, Any]) -> Dict[str, Any]:
     try:
-        requests.post(f"{TG_BASE_URL}/{method}", json=payload, timeout=20)
+        r = http_request("telegram", "POST", f"{TG_BASE_URL}/{method}", json=payload)
+        try:
+            return r.json()
+        except ValueError:
+            return {"ok": r.ok, "error_code": r.status_code, "description": r.text[:200]}
     except Exception as e:
         print(f"Telegram {method} error: {e}")
+        return {"ok": False, "error_code": 0, "description": str(e)}
+
+
+# ============================================================
+# TELEGRAM OUTBOX
+# ============================================================
+# Số nhỏ hơn được gửi trước
+TG_PRIORITY_PAYMENT = 0
+TG_PRIORITY_NORMAL = 1
+TG_PRIORITY_REMINDER = 2
+TG_PRIORITY_BULK = 3
+
+_TG_OUTBOX: List[Tuple[int, int, Dict[str, Any]]] = []
+_TG_OUTBOX_COND = threading.Condition()
+_TG_OUTBOX_SEQ = itertools.count()
+# Tin của cùng một chat luôn đi theo thứ tự gửi, chỉ job đầu hàng của chat mới được lấy ra
+_TG_CHAT_QUEUES: Dict[Any, "collections.deque"] = {}
+_TG_CHAT_BUCKETS: Dict[Any, TokenBucket] = {}
+_TG_CHAT_BUSY: set = set()
+_TG_DISPATCHERS: List[threading.Thread] = []
+TG_DISPATCH_STATS = {
+    "queued": 0,
+    "delivered": 0,
+    "failed": 0,
+    "retried": 0,
+    "rate_limited": 0,
+}
+
+
+def _tg_chat_bucket(chat_id: Any) -> TokenBucket:
+    bucket = _TG_CHAT_BUCKETS.get(chat_id)
+    if bucket is None:
+        if len(_TG_CHAT_BUCKETS) > 10000:
+            idle = [cid for cid in _TG_CHAT_BUCKETS if cid not in _TG_CHAT_QUEUES and cid not in _TG_CHAT_BUSY]
+            for cid in idle:
+                _TG_CHAT_BUCKETS.pop(cid, None)
+        bucket = TokenBucket(TG_CHAT_RATE, capacity=TG_CHAT_BURST)
+        _TG_CHAT_BUCKETS[chat_id] = bucket
+    return bucket
+
+
+def _push_outbound_job(job: Dict[str, Any]) -> None:
+    heapq.heappush(_TG_OUTBOX, (job["priority"], next(_TG_OUTBOX_SEQ), job))
+    _TG_OUTBOX_COND.notify()
+
+
+def _next_outbound_job() -> Optional[Dict[str, Any]]:
+    # Gọi khi đang giữ _TG_OUTBOX_COND; nếu chưa có job nào gửi được thì chờ một lúc rồi trả None
+    now = time.monotonic()
+    skipped = []
+    found = None
+    wait = None
+    while _TG_OUTBOX:
+        entry = heapq.heappop(_TG_OUTBOX)
+        job = entry[2]
+        chat_id = job["chat_id"]
+        chat_queue = _TG_CHAT_QUEUES.get(chat_id)
+        if chat_id in _TG_CHAT_BUSY or not chat_queue or chat_queue[0] is not job:
+            skipped.append(entry)
+            continue
+        delay = job.get("not_before", 0.0) - now
+        if delay <= 0:
+            delay = _tg_chat_bucket(chat_id).try_acquire()
+        if delay > 0:
+            wait = delay if wait is None else min(wait, delay)
+            skipped.append(entry)
+            continue
+        found = job
+        break
+    for entry in skipped:
+        heapq.heappush(_TG_OUTBOX, entry)
+    if found is not None:
+        _TG_CHAT_BUSY.add(found["chat_id"])
+        return found
+    _TG_OUTBOX_COND.wait(timeout=min(wait, 1.0) if wait is not None else 1.0)
+    return None
+
+
+def _finish_outbound_job(job: Dict[str, Any], result: Optional[Dict[str, Any]]) -> None:
+    # result=None nghĩa là đưa job quay lại hàng đợi để thử lại
+    with _TG_OUTBOX_COND:
+        chat_id = job["chat_id"]
+        _TG_CHAT_BUSY.discard(chat_id)
+        if result is None:
+            _push_outbound_job(job)
+            _TG_OUTBOX_COND.notify_all()
+            return
+        chat_queue = _TG_CHAT_QUEUES.get(chat_id)
+        if chat_queue and chat_queue[0] is job:
+            chat_queue.popleft()
+        if not chat_queue:
+            _TG_CHAT_QUEUES.pop(chat_id, None)
+        if result.get("ok"):
+            TG_DISPATCH_STATS["delivered"] += 1
+        else:
+            TG_DISPATCH_STATS["failed"] += 1
+        _TG_OUTBOX_COND.notify_all()
+    job["result"] = result
+    job["done"].set()
+
+
+def _deliver_outbound_job(job: Dict[str, Any]) -> None:
+    TG_GLOBAL_BUCKET.acquire()
+    result = tg_request(job["method"], job["payload"])
+    job["attempts"] += 1
+    if result.get("ok"):
+        _finish_outbound_job(job, result)
+        return
+
+    error_code = int(result.get("error_code") or 0)
+    if error_code == 429 and job["attempts"] < job["max_attempts"] * 2:
+        retry_after = float((result.get("parameters") or {}).get("retry_after") or 1)
+        TG_DISPATCH_STATS["rate_limited"] += 1
+        TG_GLOBAL_BUCKET.pause(retry_after)
+        with _TG_OUTBOX_COND:
+            _tg_chat_bucket(job["chat_id"]).pause(retry_after)
+        job["not_before"] = time.monotonic() + retry_after
+        _finish_outbound_job(job, None)
+        return
+    if (error_code == 0 or error_code >= 500) and job["attempts"] < job["max_attempts"]:
+        TG_DISPATCH_STATS["retried"] += 1
+        job["not_before"] = time.monotonic() + min(2 ** job["attempts"], 30)
+        _finish_outbound_job(job, None)
+        return
+
+    if error_code not in (400, 403):
+        print(f"Telegram {job['method']} to {job['chat_id']} failed: {result.get('description')}")
+    _finish_outbound_job(job, result)
+
+
+def _tg_dispatch_worker() -> None:
+    while True:
+        with _TG_OUTBOX_COND:
+            job = _next_outbound_job()
+        if job is None:
+            continue
+        try:
+            _deliver_outbound_job(job)
+        except Exception as e:
+            print(f"Telegram dispatch error: {e}")
+            _finish_outbound_job(job, {"ok": False, "error_code": 0, "description": str(e)})
+
+
+def _ensure_tg_dispatchers() -> None:
+    if _TG_DISPATCHERS:
+        return
+    with _TG_OUTBOX_COND:
+        if _TG_DISPATCHERS:
+            return
+        for idx in range(max(1, TG_DISPATCH_WORKERS)):
+            worker = threading.Thread(target=_tg_dispatch_worker, name=f"tg-dispatch-{idx}", daemon=True)
+            worker.start()
+            _TG_DISPATCHERS.append(worker)
+
+
+def tg_dispatch(method: str, payload: Dict[str, Any], priority: int = TG_PRIORITY_NORMAL,
+                wait: bool = False, max_attempts: int = 0) -> Dict[str, Any]:
+    _ensure_tg_dispatchers()
+    job = {
+        "method": method,
+        "payload": payload,
+        "chat_id": payload.get("chat_id"),
+        "priority": int(priority),
+        "attempts": 0,
+        "max_attempts": max(1, max_attempts or TG_SEND_MAX_ATTEMPTS),
+        "not_before": 0.0,
+        "done": threading.Event(),
+        "result": None,
+    }
+    with _TG_OUTBOX_COND:
+        _TG_CHAT_QUEUES.setdefault(job["chat_id"], collections.deque()).append(job)
+        _push_outbound_job(job)
+        TG_DISPATCH_STATS["queued"] += 1
+    if not wait:
+        return {"ok": True, "queued": True}
+    if not job["done"].wait(TG_SEND_WAIT_TIMEOUT):
+        # Tin vẫn nằm trong hàng đợi và có thể còn được gửi
+        return {"ok": False, "error_code": 0, "description": "dispatch_timeout", "queued": True}
+    return job["result"]
+
+
+def drain_tg_outbox(timeout: Optional[float] = None) -> bool:
+    deadline = time.monotonic() + (UPDATE_DRAIN_TIMEOUT if timeout is None else timeout)
+    with _TG_OUTBOX_COND:
+        while _TG_CHAT_QUEUES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print(f"Telegram outbox drain timeout, {len(_TG_OUTBOX)} messages left")
+                return False
+            _TG_OUTBOX_COND.wait(timeout=min(remaining, 0.5))
+    return True
+
+
+def tg_dispatch_stats() -> Dict[str, Any]:
+    with _TG_OUTBOX_COND:
+        pending = len(_TG_OUTBOX)
+        chats = len(_TG_CHAT_QUEUES)
+    return {
+        "workers": len(_TG_DISPATCHERS),
+        "pending": pending,
+        "pending_chats": chats,
+        **TG_DISPATCH_STATS,
+    }
 
 
-def tg_send_message(chat_id: int, text: str, reply_markup: Optional[Dict[str, Any]] = None, parse_mode: Optional[str] = None):
+def tg_send_message(chat_id: int, text: str, reply_markup: Optional[Dict[str, Any]] = None, parse_mode: Optional[str] = None,
+                    priority: int = TG_PRIORITY_NORMAL, wait: bool = False, max_attempts: int = 0):
     payload = {"chat_id": chat_id, "text": text}
     if reply_markup:
         payload["reply_markup"] = reply_markup
     if parse_mode:
         payload["parse_mode"] = parse_mode
-    tg_request("sendMessage", payload)
+    return tg_dispatch("sendMessage", payload, priority=priority, wait=wait, max_attempts=max_attempts)
 
 
-def tg_send_photo(chat_id: int, photo_url: str, caption: Optional[str] = None, reply_markup: Optional[Dict[str, Any]] = None):
+def tg_send_photo(chat_id: int, photo_url: str, caption: Optional[str] = None, reply_markup: Optional[Dict[str, Any]] = None,
+                  priority: int = TG_PRIORITY_NORMAL, wait: bool = False):
     payload = {"chat_id": chat_id, "photo": photo_url}
     if caption:
         payload["caption"] = caption
     if reply_markup:
         payload["reply_markup"] = reply_markup
-    tg_request("sendPhoto", payload)
+    return tg_dispatch("sendPhoto", payload, priority=priority, wait=wait)
 
 
-def tg_edit_message(chat_id: int, message_id: int, text: str, reply_markup: Optional[Dict[str, Any]] = None):
+def tg_edit_message(chat_id: int, message_id: int, text: str, reply_markup: Optional[Dict[str, Any]] = None,
+                    priority: int = TG_PRIORITY_NORMAL, wait: bool = False):
     payload = {"chat_id": chat_id, "message_id": message_id, "text": text}
     if reply_markup:
         payload["reply_markup"] = reply_markup
-    tg_request("editMessageText", payload)
+    return tg_dispatch("editMessageText", payload, priority=priority, wait=wait)
 
 
 def tg_answer_callback(callback_query_id: str):
+    # Phải trả lời callback ngay, không đi qua hàng đợi
     tg_request("answerCallbackQuery", {"callback_query_id": callback_query_id})
 
 
@@ -693,26 +2518,45 @@ def save_user(user_id: int, username: str, full_name: str):
 
 
 def get_settings() -> Dict[str, Any]:
-    settings = load_gist_json(SETTINGS_FILE, default_settings())
+    settings = storage_load(SETTINGS_FILE, default_settings())
     for k, v in default_settings().items():
         settings.setdefault(k, v)
     return settings
 
 
 def get_inventory() -> Dict[str, List[Dict[str, Any]]]:
-    inventory = load_gist_json(INVENTORY_FILE, default_inventory())
+    inventory = storage_load(INVENTORY_FILE, default_inventory())
     for code in CATALOG:
         inventory.setdefault(code, [])
     return inventory
 
 
 def save_inventory(inventory: Dict[str, Any]):
-    save_gist_json(INVENTORY_FILE, inventory)
+    storage_save(INVENTORY_FILE, inventory)
+
+
+# Số tài khoản còn trong kho theo product_code, dựng lại khi inventory.json được nạp mới
+_STOCK_COUNTS: Dict[str, Any] = {"generation": None, "counts": {}}
+
+
+def _stock_counts() -> Dict[str, int]:
+    with _INDEX_LOCK:
+        generation = storage_generation(INVENTORY_FILE)
+        if _STOCK_COUNTS["generation"] != generation:
+            inventory = storage_read_only(INVENTORY_FILE, {})
+            _STOCK_COUNTS["counts"] = {code: len(rows or []) for code, rows in inventory.items()}
+            _STOCK_COUNTS["generation"] = generation
+        return _STOCK_COUNTS["counts"]
+
+
+def _adjust_stock_count(product_code: str, delta: int) -> None:
+    with _INDEX_LOCK:
+        counts = _STOCK_COUNTS["counts"]
+        counts[product_code] = max(0, counts.get(product_code, 0) + delta)
 
 
 def get_stock_count(product_code: str) -> int:
-    inventory = get_inventory()
-    return len(inventory.get(product_code, []))
+    return int(_stock_counts().get(product_code, 0))
 
 
 def is_in_stock(product_code: str) -> bool:
@@ -725,35 +2569,35 @@ def stock_label(product_code: str) -> str:
 
 
 def get_customers() -> Dict[str, Any]:
-    return load_gist_json(CUSTOMERS_FILE, {})
+    return storage_load(CUSTOMERS_FILE, {})
 
 
 def save_customers(data: Dict[str, Any]):
-    save_gist_json(CUSTOMERS_FILE, data)
+    storage_save(CUSTOMERS_FILE, data)
 
 
 def get_orders() -> Dict[str, Any]:
-    return load_gist_json(ORDERS_FILE, {})
+    return storage_load(ORDERS_FILE, {})
 
 
 def save_orders(data: Dict[str, Any]):
-    save_gist_json(ORDERS_FILE, data)
+    storage_save(ORDERS_FILE, data)
 
 
 def get_pending_orders() -> Dict[str, Any]:
-    return load_gist_json(PENDING_ORDERS_FILE, {})
+    return storage_load(PENDING_ORDERS_FILE, {})
 
 
 def save_pending_orders(data: Dict[str, Any]):
-    save_gist_json(PENDING_ORDERS_FILE, data)
+    storage_save(PENDING_ORDERS_FILE, data)
 
 
 def get_paid_orders() -> Dict[str, Any]:
-    return load_gist_json(PAID_ORDERS_FILE, {})
+    return storage_load(PAID_ORDERS_FILE, {})
 
 
 def save_paid_orders(data: Dict[str, Any]):
-    save_gist_json(PAID_ORDERS_FILE, data)
+    storage_save(PAID_ORDERS_FILE, data)
 
 
 def mark_paid_order(order_code: str, order: Dict[str, Any], amount: int, transaction_ref: str = "", source: str = "payos_webhook") -> None:
@@ -775,19 +2619,19 @@ def get_paid_order(order_code: str) -> Optional[Dict[str, Any]]:
 
 
 def get_secrets() -> Dict[str, str]:
-    return load_gist_json(SECRETS_FILE, {})
+    return storage_load(SECRETS_FILE, {})
 
 
 def save_secrets(data: Dict[str, str]):
-    save_gist_json(SECRETS_FILE, data)
+    storage_save(SECRETS_FILE, data)
 
 
 def get_reminder_log() -> Dict[str, Any]:
-    return load_gist_json(REMINDER_LOG_FILE, {})
+    return storage_load(REMINDER_LOG_FILE, {})
 
 
 def save_reminder_log(data: Dict[str, Any]):
-    save_gist_json(REMINDER_LOG_FILE, data)
+    storage_save(REMINDER_LOG_FILE, data)
 
 
 def today_key() -> str:
@@ -908,7 +2752,7 @@ def create_payos_payment_link(amount: int, payment_code: str, product_name: str)
     }
     payload["signature"] = sign_payos_payment_request(int(amount), order_code, description, PAYOS_CANCEL_URL, PAYOS_RETURN_URL)
     try:
-        r = requests.post(f"{PAYOS_BASE_URL}/v2/payment-requests", headers=payos_headers(), json=payload, timeout=20)
+        r = http_request("payos", "POST", f"{PAYOS_BASE_URL}/v2/payment-requests", headers=payos_headers(), json=payload)
         data = r.json()
         if r.ok and str(data.get("code")) == "00" and data.get("data"):
             info = data["data"]
@@ -930,7 +2774,7 @@ def get_payos_payment_status(order_code: int | str) -> Dict[str, Any]:
     if not (PAYOS_CLIENT_ID and PAYOS_API_KEY):
         return {"ok": False, "error": "payos_not_configured"}
     try:
-        r = requests.get(f"{PAYOS_BASE_URL}/v2/payment-requests/{order_code}", headers=payos_headers(), timeout=20)
+        r = http_request("payos", "GET", f"{PAYOS_BASE_URL}/v2/payment-requests/{order_code}", headers=payos_headers())
         data = r.json()
         if not r.ok:
             return {"ok": False, "error": data}
@@ -943,11 +2787,12 @@ def confirm_payos_webhook_url() -> None:
     if not (PAYOS_CLIENT_ID and PAYOS_API_KEY and PAYOS_WEBHOOK_URL):
         return
     try:
-        r = requests.post(
+        r = http_request(
+            "payos",
+            "POST",
             f"{PAYOS_BASE_URL}/confirm-webhook",
             headers=payos_headers(),
             json={"webhookUrl": PAYOS_WEBHOOK_URL},
-            timeout=20,
         )
         print("payOS confirm-webhook:", r.status_code, r.text)
     except Exception as e:
@@ -1002,15 +2847,7 @@ def customer_all_items(user_id: int) -> List[Dict[str, Any]]:
 def add_customer_product(user_id: int, username: str, full_name: str, product_code: str,
                          account_data: Optional[Dict[str, Any]], duration_days: int,
                          order_code: str, delivered_by: str = "system") -> Dict[str, Any]:
-    customers = get_customers()
     key = str(user_id)
-    if key not in customers:
-        customers[key] = {
-            "username": username,
-            "full_name": full_name,
-            "created_at": now_ts(),
-            "products": [],
-        }
     expires_at = now_ts() + duration_days * 86400
     record = {
         "product_code": product_code,
@@ -1026,10 +2863,24 @@ def add_customer_product(user_id: int, username: str, full_name: str, product_co
         "account": account_data or {},
         "created_at": now_ts(),
     }
-    customers[key]["username"] = username
-    customers[key]["full_name"] = full_name
-    customers[key].setdefault("products", []).append(record)
-    save_customers(customers)
+
+    # Thêm vào danh sách sản phẩm trong 1 lần ghi nguyên tử: 2 đơn cùng khách giao song song
+    # không ghi đè danh sách của nhau
+    def append(customers: Dict[str, Any]) -> int:
+        customer = customers.setdefault(key, {
+            "username": username,
+            "full_name": full_name,
+            "created_at": now_ts(),
+            "products": [],
+        })
+        customer["username"] = username
+        customer["full_name"] = full_name
+        products = customer.setdefault("products", [])
+        products.append(dict(record))
+        return len(products) - 1
+
+    item_index = storage_update(CUSTOMERS_FILE, {}, append)
+    storage_after_commit(lambda: _index_expiry(key, item_index, expires_at))
     return record
 
 
@@ -1039,55 +2890,60 @@ def format_expiry(ts: int) -> str:
 
 def extend_customer_product(user_id: int, item_index: int, duration_days: int,
                             order_code: str, delivered_by: str = "system") -> Dict[str, Any]:
-    customers = get_customers()
     key = str(user_id)
 
-    if key not in customers:
-        raise ValueError("customer_not_found")
+    def extend(customers: Dict[str, Any]) -> Dict[str, Any]:
+        if key not in customers:
+            raise ValueError("customer_not_found")
 
-    items = customers[key].get("products", [])
-    if item_index < 0 or item_index >= len(items):
-        raise ValueError("product_not_found")
+        items = customers[key].get("products", [])
+        if item_index < 0 or item_index >= len(items):
+            raise ValueError("product_not_found")
 
-    item = items[item_index]
-    base_time = max(now_ts(), int(item.get("expires_at", 0) or 0))
-    new_expires_at = base_time + duration_days * 86400
-
-    item["expires_at"] = new_expires_at
-    item["duration_days"] = int(item.get("duration_days", 0)) + duration_days
-    item["months"] = max(1, int(round(item["duration_days"] / 30)))
-    item["status"] = "active"
-    item["last_renewed_at"] = now_ts()
-    item["last_renew_order_code"] = order_code
-    item["delivered_by"] = delivered_by
-
-    customers[key]["products"][item_index] = item
-    save_customers(customers)
+        item = items[item_index]
+        base_time = max(now_ts(), int(item.get("expires_at", 0) or 0))
+        item["expires_at"] = base_time + duration_days * 86400
+        item["duration_days"] = int(item.get("duration_days", 0)) + duration_days
+        item["months"] = max(1, int(round(item["duration_days"] / 30)))
+        item["status"] = "active"
+        item["last_renewed_at"] = now_ts()
+        item["last_renew_order_code"] = order_code
+        item["delivered_by"] = delivered_by
+        return dict(item)
+
+    item = storage_update(CUSTOMERS_FILE, {}, extend)
+    storage_after_commit(lambda: _index_expiry(key, item_index, int(item["expires_at"])))
     return item
 
 
 def allocate_inventory_account(product_code: str) -> Optional[Dict[str, Any]]:
-    inventory = get_inventory()
-    rows = inventory.get(product_code, [])
-    if not rows:
-        return None
-    acc = rows.pop(0)
-    inventory[product_code] = rows
-    save_inventory(inventory)
+    # Lấy và xoá tài khoản trong cùng 1 lần ghi nguyên tử: 2 đơn song song không nhận trùng tài khoản
+    def take(inventory: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        rows = inventory.get(product_code, [])
+        if not rows:
+            return None
+        acc = rows.pop(0)
+        inventory[product_code] = rows
+        return acc
+
+    acc = storage_update(INVENTORY_FILE, default_inventory(), take)
+    if acc:
+        storage_after_commit(lambda: _adjust_stock_count(product_code, -1))
     return acc
 
 
 def add_inventory_account(product_code: str, username: str, password: str,
                           account_key: str = "", note: str = "") -> None:
-    inventory = get_inventory()
-    inventory.setdefault(product_code, []).append({
+    row = {
         "username": username,
         "password": password,
         "account_key": account_key,
         "note": note,
         "created_at": now_ts(),
-    })
-    save_inventory(inventory)
+    }
+    storage_update(INVENTORY_FILE, default_inventory(),
+                   lambda inventory: inventory.setdefault(product_code, []).append(row))
+    storage_after_commit(lambda: _adjust_stock_count(product_code, 1))
 
 
 def set_secret(account_key: str, secret: str):
@@ -1158,65 +3014,112 @@ def build_admin_expiry_reminder_text(user_id: int, customer: Dict[str, Any], ite
     )
 
 
+# Chỉ số hạn dùng theo ngày: expires_at // 86400 -> {(user_id, item_index)} của các gói active
+_EXPIRY_INDEX: Dict[str, Any] = {"generation": None, "buckets": {}, "days": {}}
+
+
+def _expiry_day(expires_at: int) -> int:
+    return max(0, int(expires_at or 0)) // 86400
+
+
+def _index_expiry(user_id: str, item_index: int, expires_at: int) -> None:
+    with _INDEX_LOCK:
+        buckets = _EXPIRY_INDEX["buckets"]
+        days = _EXPIRY_INDEX["days"]
+        entry = (str(user_id), int(item_index))
+        old_day = days.get(entry)
+        if old_day is not None:
+            buckets.get(old_day, set()).discard(entry)
+            if not buckets.get(old_day):
+                buckets.pop(old_day, None)
+        day = _expiry_day(expires_at)
+        buckets.setdefault(day, set()).add(entry)
+        days[entry] = day
+
+
+def _expiry_candidates(until_ts: float) -> List[tuple[str, int]]:
+    with _INDEX_LOCK:
+        generation = storage_generation(CUSTOMERS_FILE)
+        if _EXPIRY_INDEX["generation"] != generation:
+            _EXPIRY_INDEX["buckets"] = {}
+            _EXPIRY_INDEX["days"] = {}
+            for user_id, customer in storage_read_only(CUSTOMERS_FILE, {}).items():
+                for idx, item in enumerate(customer.get("products", [])):
+                    if item.get("status", "active") == "active":
+                        _index_expiry(user_id, idx, int(item.get("expires_at", 0) or 0))
+            _EXPIRY_INDEX["generation"] = generation
+        last_day = _expiry_day(int(until_ts))
+        entries = []
+        for day, bucket in _EXPIRY_INDEX["buckets"].items():
+            if day <= last_day:
+                entries.extend(bucket)
+        return sorted(entries)
+
+
 def process_expiry_reminders() -> Dict[str, Any]:
-    customers = get_customers()
+    # Chỉ duyệt các gói hết hạn trong vòng 2 ngày tới (và đã hết hạn), không quét toàn bộ khách
+    customers = storage_read_only(CUSTOMERS_FILE, {})
     reminder_log = get_reminder_log()
     today = today_key()
     sent = []
     skipped = 0
 
-    for user_id, customer in customers.items():
+    for user_id, idx in _expiry_candidates(time.time() + 2 * 86400):
+        customer = customers.get(user_id) or {}
         items = customer.get("products", [])
-        for idx, item in enumerate(items):
-            if item.get("status", "active") != "active":
-                continue
+        if idx >= len(items):
+            continue
+        item = items[idx]
+        if item.get("status", "active") != "active":
+            continue
 
-            expires_at = int(item.get("expires_at", 0) or 0)
-            if expires_at <= 0:
-                skipped += 1
-                continue
+        expires_at = int(item.get("expires_at", 0) or 0)
+        if expires_at <= 0:
+            skipped += 1
+            continue
 
-            days_left = days_until_expiry(expires_at)
-            if days_left not in (2, 1, 0):
-                continue
+        days_left = days_until_expiry(expires_at)
+        if days_left not in (2, 1, 0):
+            continue
 
-            log_key = f"{user_id}:{idx}:{today}"
-            if reminder_log.get(log_key):
-                continue
+        log_key = f"{user_id}:{idx}:{today}"
+        if reminder_log.get(log_key):
+            continue
 
-            try:
-                user_msg = build_expiry_reminder_text(item, days_left)
-                tg_send_message(
+        try:
+            user_msg = build_expiry_reminder_text(item, days_left)
+            tg_send_message(
+                int(user_id),
+                user_msg,
+                reply_markup=build_expiry_reminder_keyboard(idx),
+                priority=TG_PRIORITY_REMINDER,
+            )
+
+            if ADMIN_CHAT_ID:
+                admin_msg = build_admin_expiry_reminder_text(
                     int(user_id),
-                    user_msg,
-                    reply_markup=build_expiry_reminder_keyboard(idx)
+                    customer,
+                    item,
+                    days_left
                 )
-
-                if ADMIN_CHAT_ID:
-                    admin_msg = build_admin_expiry_reminder_text(
-                        int(user_id),
-                        customer,
-                        item,
-                        days_left
-                    )
-                    tg_send_message(ADMIN_CHAT_ID, admin_msg)
-
-                reminder_log[log_key] = {
-                    "user_id": int(user_id),
-                    "product_index": idx,
-                    "product_code": item.get("product_code"),
-                    "days_left": days_left,
-                    "sent_at": now_ts(),
-                    "date": today,
-                    "sent_to_admin": bool(ADMIN_CHAT_ID),
-                }
-                sent.append({
-                    "user_id": int(user_id),
-                    "product_code": item.get("product_code"),
-                    "days_left": days_left,
-                })
-            except Exception:
-                skipped += 1
+                tg_send_message(ADMIN_CHAT_ID, admin_msg, priority=TG_PRIORITY_REMINDER)
+
+            reminder_log[log_key] = {
+                "user_id": int(user_id),
+                "product_index": idx,
+                "product_code": item.get("product_code"),
+                "days_left": days_left,
+                "sent_at": now_ts(),
+                "date": today,
+                "sent_to_admin": bool(ADMIN_CHAT_ID),
+            }
+            sent.append({
+                "user_id": int(user_id),
+                "product_code": item.get("product_code"),
+                "days_left": days_left,
+            })
+        except Exception:
+            skipped += 1
 
     save_reminder_log(reminder_log)
     return {
@@ -1559,15 +3462,40 @@ def create_pending_order(user_id: int, chat_id: int, username: str, full_name: s
         "last_check_at": 0,
     }
     save_pending_orders(orders)
+    with _INDEX_LOCK:
+        _PAYOS_INDEX["codes"][str(payos["payos_order_code"])] = order_code
     return orders[order_code]
 
 
+# payos_order_code -> order_code trong pending_orders.json
+_PAYOS_INDEX: Dict[str, Any] = {"generation": None, "codes": {}}
+
+
+def _payos_index() -> Dict[str, str]:
+    with _INDEX_LOCK:
+        generation = storage_generation(PENDING_ORDERS_FILE)
+        if _PAYOS_INDEX["generation"] != generation:
+            _PAYOS_INDEX["codes"] = {
+                str(order.get("payos_order_code")): key
+                for key, order in get_pending_orders().items()
+                if order.get("payos_order_code")
+            }
+            _PAYOS_INDEX["generation"] = generation
+        return _PAYOS_INDEX["codes"]
+
+
+def _unindex_payos_order(order: Dict[str, Any]) -> None:
+    with _INDEX_LOCK:
+        _PAYOS_INDEX["codes"].pop(str(order.get("payos_order_code")), None)
+
+
 def find_pending_order_by_payos_order_code(payos_order_code: int | str):
-    orders = get_pending_orders()
     order_code_str = str(payos_order_code)
-    for key, order in orders.items():
-        if str(order.get("payos_order_code")) == order_code_str:
-            return key, order, orders
+    key = _payos_index().get(order_code_str)
+    orders = get_pending_orders()
+    order = orders.get(key) if key else None
+    if order and str(order.get("payos_order_code")) == order_code_str:
+        return key, order, orders
     return None, None, orders
 
 
@@ -1587,12 +3515,43 @@ def auto_finalize_order(order_code: str, amount: int, source: str = "payos_webho
     if paid and paid.get("delivery_status") == "delivered":
         return {"ok": True, "status": "already_delivered"}
 
-    finalized = finalize_order(order_code, delivered_by=source)
-    finalized["delivery_status"] = "delivered"
-    mark_paid_order(order_code, finalized, amount=amount, transaction_ref=transaction_ref, source=source)
+    payment = {"amount": amount, "transaction_ref": transaction_ref, "source": source}
+    try:
+        finalized = finalize_order(order_code, delivered_by=source, payment=payment)
+    except ValueError as e:
+        if str(e) not in ("order_in_progress", "order_not_found"):
+            raise
+        # Luồng khác đã nhận đơn: gắn thanh toán vào đơn chờ để bên đó (kể cả admin) ghi cùng lúc giao.
+        # Bên đó chưa xong hoặc giao lỗi thì báo "in_progress" để bên thanh toán gửi lại webhook.
+        if attach_pending_payment(order_code, payment):
+            return {"ok": False, "status": "in_progress"}
+        return record_late_payment(order_code, payment)
     return {"ok": True, "status": "paid", "order": finalized}
 
 
+def attach_pending_payment(order_code: str, payment: Dict[str, Any]) -> bool:
+    def attach(pending: Dict[str, Any]) -> bool:
+        order = pending.get(order_code)
+        if not order:
+            return False
+        order["payment"] = dict(payment)
+        return True
+
+    return storage_update(PENDING_ORDERS_FILE, {}, attach)
+
+
+def record_late_payment(order_code: str, payment: Dict[str, Any]) -> Dict[str, Any]:
+    # Đơn đã rời danh sách chờ: chỉ coi là xong khi đơn thật sự đã giao, và ghi thanh toán nếu còn thiếu
+    paid = get_paid_order(order_code)
+    if paid and paid.get("delivery_status") == "delivered":
+        return {"ok": True, "status": "already_delivered"}
+    delivered = get_orders().get(order_code)
+    if not delivered or delivered.get("delivery_status") != "delivered":
+        raise ValueError("order_not_found")
+    mark_paid_order(order_code, delivered, **payment)
+    return {"ok": True, "status": "already_delivered"}
+
+
 def sync_order_status(order_code: str) -> Dict[str, Any]:
     pending = get_pending_orders()
     order = pending.get(order_code)
@@ -1623,7 +3582,9 @@ def sync_order_status(order_code: str) -> Dict[str, Any]:
 
     expected = int(order["price"])
     if status == "PAID" or amount_paid >= expected:
-        auto_finalize_order(order_code, max(amount_paid, expected), source="payos_status_sync", transaction_ref="manual_status_sync")
+        result = auto_finalize_order(order_code, max(amount_paid, expected), source="payos_status_sync", transaction_ref="manual_status_sync")
+        if not result["ok"]:
+            return {"ok": False, "message": "Thanh toán đã thành công, đơn đang được giao. Vui lòng kiểm tra lại sau ít phút."}
         return {"ok": True, "message": "Thanh toán đã thành công. Bot đã tự xử lý giao hàng."}
 
     if status == "CANCELLED":
@@ -1635,12 +3596,61 @@ def sync_order_status(order_code: str) -> Dict[str, Any]:
     return {"ok": True, "message": f"payOS hiện báo trạng thái: {status or 'PENDING'}. Đơn vẫn đang chờ thanh toán."}
 
 
-def finalize_order(order_code: str, delivered_by: str = "system") -> Dict[str, Any]:
-    pending = get_pending_orders()
-    order = pending.get(order_code)
-    if not order:
-        raise ValueError("order_not_found")
-
+def claim_pending_order(order_code: str) -> Dict[str, Any]:
+    # Đánh dấu đơn đang được giao trong 1 lần ghi nguyên tử: webhook, đồng bộ payOS và admin
+    # cùng xác nhận 1 đơn thì chỉ 1 bên được giao hàng
+    def claim(pending: Dict[str, Any]) -> Tuple[str, Optional[Dict[str, Any]]]:
+        order = pending.get(order_code)
+        if not order:
+            return "order_not_found", None
+        started = int(order.get("finalizing_at") or 0)
+        if started and now_ts() - started < FINALIZE_CLAIM_TIMEOUT:
+            return "order_in_progress", None
+        order["finalizing_at"] = now_ts()
+        return "", dict(order)
+
+    error, order = storage_update(PENDING_ORDERS_FILE, {}, claim)
+    if error:
+        raise ValueError(error)
+    order.pop("finalizing_at", None)
+    return order
+
+
+def release_pending_order(order_code: str, remove: bool = False) -> None:
+    def release(pending: Dict[str, Any]) -> None:
+        if remove:
+            pending.pop(order_code, None)
+        elif order_code in pending:
+            pending[order_code].pop("finalizing_at", None)
+
+    storage_update(PENDING_ORDERS_FILE, {}, release)
+
+
+def finalize_order(order_code: str, delivered_by: str = "system",
+                   payment: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # Coupon, kho, khách hàng, đơn, đơn chờ và (nếu có payment) đơn đã thanh toán được ghi
+    # trong 1 transaction; lỗi giữa chừng thì không file nào bị sửa
+    order = claim_pending_order(order_code)
+    order.pop("payment", None)
+    try:
+        with storage_transaction():
+            # Thanh toán đến trong lúc đơn đang được giao (xem attach_pending_payment); khoá đơn chờ
+            # tới lúc commit nên không có thanh toán nào được gắn thêm sau lần đọc này
+            attached = storage_update(PENDING_ORDERS_FILE, {},
+                                      lambda pending: (pending.get(order_code) or {}).get("payment"))
+            finalized, message = _deliver_order(order_code, order, delivered_by)
+            payment = payment or attached
+            if payment:
+                mark_paid_order(order_code, finalized, **payment)
+    except BaseException:
+        release_pending_order(order_code)
+        raise
+    _unindex_payos_order(order)
+    tg_send_message(order["chat_id"], message, priority=TG_PRIORITY_PAYMENT)
+    return finalized
+
+
+def _deliver_order(order_code: str, order: Dict[str, Any], delivered_by: str) -> Tuple[Dict[str, Any], str]:
     product_code = order["product_code"]
     item = CATALOG[product_code]
     order_type = order.get("order_type", "new")
@@ -1682,11 +3692,8 @@ def finalize_order(order_code: str, delivered_by: str = "system") -> Dict[str, A
         }
         save_orders(all_orders)
 
-        del pending[order_code]
-        save_pending_orders(pending)
-
-        tg_send_message(order["chat_id"], message)
-        return all_orders[order_code]
+        release_pending_order(order_code, remove=True)
+        return all_orders[order_code], message
 
     if item["type"] == "shared":
         account_data = allocate_inventory_account(product_code)
@@ -1734,11 +3741,208 @@ def finalize_order(order_code: str, delivered_by: str = "system") -> Dict[str, A
     }
     save_orders(all_orders)
 
-    del pending[order_code]
-    save_pending_orders(pending)
+    release_pending_order(order_code, remove=True)
+    return all_orders[order_code], message
+
+
+# ============================================================
+# BROADCAST
+# ============================================================
+# Mỗi đợt broadcast là 1 job: broadcasts.json chỉ giữ thông tin chung và số đếm kết quả.
+# Trong lúc gửi, danh sách người nhận và kết quả từng người (delivered / blocked / failed / unknown)
+# nằm riêng ở broadcast_progress.json, được lưu định kỳ nên nếu process bị dừng giữa chừng,
+# lúc khởi động lại sẽ gửi tiếp cho những người chưa có kết quả. Job xong thì phần này bị xoá.
+_BROADCAST_LOCK = threading.RLock()
+_BROADCAST_RUNNING: Dict[str, Dict[str, Any]] = {}
+
+
+def get_broadcasts() -> Dict[str, Any]:
+    return storage_load(BROADCASTS_FILE, {})
+
+
+def save_broadcasts(data: Dict[str, Any]):
+    storage_save(BROADCASTS_FILE, data)
+
+
+def get_broadcast_progress() -> Dict[str, Any]:
+    return storage_load(BROADCAST_PROGRESS_FILE, {})
+
 
-    tg_send_message(order["chat_id"], message)
-    return all_orders[order_code]
+def save_broadcast_progress(data: Dict[str, Any]):
+    storage_save(BROADCAST_PROGRESS_FILE, data)
+
+
+def _save_broadcast_job(job: Dict[str, Any]) -> None:
+    # Lưu thông tin chung của job; chỉ gọi lúc bắt đầu và lúc xong, không gọi mỗi checkpoint
+    with _BROADCAST_LOCK:
+        job["updated_at"] = now_ts()
+        jobs = get_broadcasts()
+        jobs[job["job_id"]] = job
+        for job_id, item in list(jobs.items()):
+            # Job lưu theo kiểu cũ còn nguyên recipients/results thì cũng thu gọn lại
+            if "recipients" in item and (item is job or item.get("status") != "running"):
+                jobs[job_id] = {**{k: v for k, v in item.items() if k not in ("recipients", "results")},
+                                "counts": broadcast_counts(item)}
+        finished = sorted((j for j in jobs.values() if j.get("status") != "running"),
+                          key=lambda j: int(j.get("created_at", 0) or 0))
+        for old in finished[:max(0, len(finished) - max(0, BROADCAST_HISTORY_LIMIT))]:
+            jobs.pop(old.get("job_id"), None)
+        save_broadcasts(jobs)
+        _checkpoint_broadcast_job(job)
+
+
+def _checkpoint_broadcast_job(job: Dict[str, Any]) -> None:
+    with _BROADCAST_LOCK:
+        progress = get_broadcast_progress()
+        if job.get("status") == "running":
+            progress[job["job_id"]] = {"recipients": job.get("recipients", []), "results": dict(job.get("results") or {})}
+        elif job["job_id"] in progress:
+            progress.pop(job["job_id"])
+        else:
+            return
+        save_broadcast_progress(progress)
+
+
+def broadcast_counts(job: Dict[str, Any]) -> Dict[str, int]:
+    with _BROADCAST_LOCK:
+        if "recipients" not in job:
+            # Job đã xong (hoặc đang chạy ở process khác): chỉ còn số đếm
+            return dict(job.get("counts") or {"total": 0, "delivered": 0, "blocked": 0,
+                                               "failed": 0, "unknown": 0, "pending": 0})
+        results = list((job.get("results") or {}).values())
+        total = len(job.get("recipients") or [])
+    counts = {
+        "total": total,
+        "delivered": results.count("delivered"),
+        "blocked": results.count("blocked"),
+        "failed": results.count("failed"),
+        "unknown": results.count("unknown"),
+    }
+    counts["pending"] = max(0, total - len(results))
+    return counts
+
+
+def _broadcast_send(user_id: int, text: str) -> str:
+    # Hàng đợi gửi tin đã lo 429 và thử lại, ở đây chỉ giữ nhịp broadcast dưới giới hạn tổng
+    TG_BROADCAST_BUCKET.acquire()
+    result = tg_send_message(user_id, text, priority=TG_PRIORITY_BULK, wait=True,
+                             max_attempts=BROADCAST_MAX_ATTEMPTS)
+    if result.get("ok"):
+        return "delivered"
+    if result.get("queued"):
+        # Hết thời gian chờ nhưng tin vẫn trong hàng đợi: không tính là lỗi, cũng không gửi lại
+        return "unknown"
+    if int(result.get("error_code") or 0) == 403:
+        return "blocked"
+    return "failed"
+
+
+def _run_broadcast(job: Dict[str, Any]) -> None:
+    job_id = job["job_id"]
+    try:
+        with _BROADCAST_LOCK:
+            results = job.setdefault("results", {})
+            pending = [uid for uid in job.get("recipients", []) if str(uid) not in results]
+
+        def send(uid: int) -> None:
+            status = _broadcast_send(int(uid), job["text"])
+            with _BROADCAST_LOCK:
+                job["results"][str(uid)] = status
+
+        with ThreadPoolExecutor(max_workers=max(1, BROADCAST_CONCURRENCY)) as pool:
+            for done, _ in enumerate(pool.map(send, pending), 1):
+                if done % max(1, BROADCAST_CHECKPOINT_EVERY) == 0:
+                    _checkpoint_broadcast_job(job)
+                    storage_flush()
+
+        job["status"] = "done"
+        job["finished_at"] = now_ts()
+        _save_broadcast_job(job)
+        storage_flush()
+        counts = broadcast_counts(job)
+        if job.get("created_by"):
+            tg_send_message(
+                int(job["created_by"]),
+                f"📢 Broadcast xong ({job_id})\n"
+                f"✅ Thành công: {counts['delivered']}\n"
+                f"🚫 Đã chặn bot: {counts['blocked']}\n"
+                f"❌ Lỗi: {counts['failed']}\n"
+                f"❔ Chưa rõ (còn trong hàng đợi): {counts['unknown']}"
+            )
+    except Exception as e:
+        print(f"broadcast {job_id} error: {e}")
+    finally:
+        with _BROADCAST_LOCK:
+            _BROADCAST_RUNNING.pop(job_id, None)
+
+
+def _start_broadcast_thread(job: Dict[str, Any]) -> None:
+    with _BROADCAST_LOCK:
+        if job["job_id"] in _BROADCAST_RUNNING:
+            return
+        _BROADCAST_RUNNING[job["job_id"]] = job
+    threading.Thread(target=_run_broadcast, args=(job,), name=f"broadcast-{job['job_id']}", daemon=True).start()
+
+
+def start_broadcast(text: str, created_by: int) -> Dict[str, Any]:
+    recipients = []
+    for uid in get_users().keys():
+        try:
+            recipients.append(int(uid))
+        except ValueError:
+            continue
+    job = {
+        "job_id": f"bc-{int(time.time() * 1000)}",
+        "text": text,
+        "created_by": created_by,
+        "created_at": now_ts(),
+        "status": "running",
+        "recipients": recipients,
+        "results": {},
+    }
+    _save_broadcast_job(job)
+    storage_flush()
+    _start_broadcast_thread(job)
+    return job
+
+
+def resume_broadcasts() -> List[str]:
+    resumed = []
+    progress = get_broadcast_progress()
+    for job in get_broadcasts().values():
+        if job.get("status") == "running" and job.get("job_id"):
+            # Job lưu theo kiểu cũ còn recipients/results ngay trong broadcasts.json
+            job = {**job, **progress.get(job["job_id"], {})}
+            job.setdefault("recipients", [])
+            _start_broadcast_thread(job)
+            resumed.append(job["job_id"])
+    return resumed
+
+
+def get_broadcast_job(job_id: str = "") -> Optional[Dict[str, Any]]:
+    with _BROADCAST_LOCK:
+        if job_id and job_id in _BROADCAST_RUNNING:
+            return _BROADCAST_RUNNING[job_id]
+        jobs = {**get_broadcasts(), **_BROADCAST_RUNNING}
+    if job_id:
+        return jobs.get(job_id)
+    if not jobs:
+        return None
+    return max(jobs.values(), key=lambda x: int(x.get("created_at", 0) or 0))
+
+
+def broadcast_status_text(job: Dict[str, Any]) -> str:
+    counts = broadcast_counts(job)
+    status = "Đang gửi" if job.get("status") == "running" else "Đã xong"
+    return (
+        f"📢 Broadcast {job.get('job_id')} | {status}\n"
+        f"Tổng người nhận: {counts['total']}\n"
+        f"✅ Thành công: {counts['delivered']}\n"
+        f"🚫 Đã chặn bot: {counts['blocked']}\n"
+        f"❌ Lỗi: {counts['failed']}\n"
+        f"❔ Chưa rõ (còn trong hàng đợi): {counts['unknown']}\n"
+        f"⏳ Còn lại: {counts['pending']}"
+    )
 
 
 # ============================================================
@@ -1763,6 +3967,7 @@ def admin_help() -> str:
         "/free_requests\n"
         "/remindnow\n"
         "/broadcast <message>\n"
+        "/broadcast_status [job_id]\n"
         "/addcoupon <code> <percent|fixed> <value> <max_total> <max_per_user> [product_code|all,...]\n"
         "/couponon <code>\n"
         "/couponoff <code>\n"
@@ -1949,25 +4154,19 @@ def handle_admin_command(chat_id: int, user_id: int, text: str):
             return
     
         message_text = text.replace("/broadcast", "", 1).strip()
-        users = get_users()
-    
-        success = 0
-        fail = 0
-    
-        for uid in users.keys():
-            try:
-                tg_send_message(int(uid), message_text)
-                success += 1
-                time.sleep(0.05)  # tránh spam limit
-            except:
-                fail += 1
-    
+        job = start_broadcast(message_text, created_by=chat_id)
         tg_send_message(chat_id,
-            f"📢 Broadcast xong\n"
-            f"✅ Thành công: {success}\n"
-            f"❌ Lỗi: {fail}"
+            f"📢 Đã bắt đầu broadcast {job['job_id']} tới {len(job['recipients'])} người.\n"
+            "Dùng /broadcast_status để xem tiến độ."
         )
         return
+    if cmd == "/broadcast_status":
+        job = get_broadcast_job(parts[1] if len(parts) >= 2 else "")
+        if not job:
+            tg_send_message(chat_id, "Chưa có broadcast nào.")
+            return
+        tg_send_message(chat_id, broadcast_status_text(job))
+        return
     if cmd == "/grant" and len(parts) >= 6:
         try:
             target_user_id = int(parts[1])
@@ -1984,7 +4183,7 @@ def handle_admin_command(chat_id: int, user_id: int, text: str):
         username_acc = parts[4]
         password_acc = parts[5]
     
-        users = load_gist_json(USERS_FILE, {})
+        users = get_users()
         user_info = users.get(str(target_user_id), {})
     
         record = add_customer_product(
@@ -2374,7 +4573,18 @@ def handle_callback(cq: Dict[str, Any]):
             tg_send_message(chat_id, "❌ Không tìm thấy đơn.")
             return
         if action == "adm_ok":
-            finalized = finalize_order(order_code, delivered_by="admin")
+            try:
+                finalized = finalize_order(order_code, delivered_by="admin")
+            except ValueError as e:
+                if str(e) not in ("order_in_progress", "order_not_found"):
+                    raise
+                tg_send_message(chat_id, f"⏳ Đơn {order_code} đang hoặc đã được xử lý.")
+                return
+            except RuntimeError as e:
+                if str(e) != "storage_commit_failed":
+                    raise
+                tg_send_message(chat_id, f"❌ Chưa lưu được dữ liệu đơn {order_code}, vui lòng thử lại.")
+                return
             tg_send_message(chat_id, f"✅ Đã xác nhận đơn {order_code} cho {finalized.get('username', '')}.")
             return
         if action == "adm_under":
@@ -2417,7 +4627,7 @@ def handle_text_message(message: Dict[str, Any]):
     if text.startswith((
         "/admin", "/addstock", "/addsecret", "/delsecret", "/grant",
         "/setprice", "/inventory", "/orders", "/products",
-        "/checkstock", "/remindnow", "/free_requests", "/broadcast",
+        "/checkstock", "/remindnow", "/free_requests", "/broadcast", "/broadcast_status",
         "/addcoupon", "/couponon", "/couponoff", "/coupons"
     )):
         handle_admin_command(chat_id, user_id, text)
@@ -2491,58 +4701,29 @@ def handle_text_message(message: Dict[str, Any]):
 
 
 # ============================================================
-# API ROUTES
+# WEBHOOK PROCESSING
 # ============================================================
-@app.on_event("startup")
-def on_startup():
-    ensure_bootstrap_files()
-    confirm_payos_webhook_url()
-
-
-@app.get("/")
-def home():
-    return {
-        "status": "running",
-        "webhook_path": WEBHOOK_PATH,
-        "webhook_url": WEBHOOK_URL,
-        "catalog_size": len(CATALOG),
-        "reminder_endpoint": "/cron/remind_expiring",
-        "payos_webhook_path": PAYOS_WEBHOOK_PATH,
-        "payos_webhook_url": PAYOS_WEBHOOK_URL,
-    }
+# Các hàm xử lý đồng bộ (gọi HTTP blocking), route async chạy chúng trong threadpool
+# để không chặn event loop của uvicorn.
+# Handler chạy song song: mỗi handler có unit of work riêng, lúc ghi được gộp với thay đổi của
+# handler khác (xem _commit_file); các bước cần nguyên tử như trừ kho, cộng điểm, nhận đơn
+# đi qua storage_update.
+def run_handler(handler, *args):
+    with unit_of_work():
+        return handler(*args)
 
 
-@app.post(WEBHOOK_PATH)
-async def telegram_webhook(request: Request):
-    try:
-        update = await request.json()
-    except Exception:
-        return PlainTextResponse("OK")
-
+def handle_update(update: Dict[str, Any]):
     if "callback_query" in update:
         handle_callback(update["callback_query"])
-        return PlainTextResponse("OK")
+        return
 
     if "message" in update:
         handle_text_message(update["message"])
-        return PlainTextResponse("OK")
-
-    return PlainTextResponse("OK")
-
-
-@app.post("/cron/remind_expiring")
-async def cron_remind_expiring():
-    result = process_expiry_reminders()
-    return JSONResponse(result)
-
+        return
 
-@app.post(PAYOS_WEBHOOK_PATH)
-async def payos_webhook(request: Request):
-    try:
-        payload = await request.json()
-    except Exception:
-        return JSONResponse({"ok": False, "error": "invalid_json"}, status_code=400)
 
+def handle_payos_webhook(payload: Dict[str, Any]):
     if PAYOS_CHECKSUM_KEY and payload.get("signature"):
         if not verify_payos_webhook_signature(payload):
             return JSONResponse({"ok": False, "error": "invalid_signature"}, status_code=400)
@@ -2555,7 +4736,10 @@ async def payos_webhook(request: Request):
     if not payos_order_code:
         return JSONResponse({"ok": False, "error": "missing_order_code"}, status_code=400)
 
-    order_code, order, pending = find_pending_order_by_payos_order_code(payos_order_code)
+    # Đơn đang được giao thì transaction giữ khoá đơn chờ tới lúc commit: đợi xong rồi mới đọc,
+    # không đọc phải bản chưa ghi xong (có thể bị huỷ)
+    with file_lock(PENDING_ORDERS_FILE):
+        order_code, order, pending = find_pending_order_by_payos_order_code(payos_order_code)
     if not order_code or not order:
         return {"ok": True, "status": "ignored_order_not_found"}
 
@@ -2568,28 +4752,34 @@ async def payos_webhook(request: Request):
         order["received_amount"] = amount
         pending[order_code] = order
         save_pending_orders(pending)
-        tg_send_message(order["chat_id"], f"⚠️ Thanh toán chưa đủ. Bạn đã chuyển {format_money(amount)}, cần {format_money(expected)}.")
+        tg_send_message(order["chat_id"], f"⚠️ Thanh toán chưa đủ. Bạn đã chuyển {format_money(amount)}, cần {format_money(expected)}.",
+                        priority=TG_PRIORITY_PAYMENT)
         return {"ok": True, "status": "underpaid"}
 
     result = auto_finalize_order(order_code, amount=max(amount, expected), source="payos_webhook", transaction_ref=transaction_ref)
-    return {"ok": True, **result}
-
+    if not result["ok"]:
+        return JSONResponse(result, status_code=503)
+    return result
 
-@app.post("/payment_webhook")
-async def payment_webhook(request: Request):
-    try:
-        payload = await request.json()
-    except Exception:
-        return JSONResponse({"ok": False, "error": "invalid_json"}, status_code=400)
 
+def handle_payment_webhook(payload: Dict[str, Any]):
     order_code = payload.get("code")
     amount = payload.get("amount")
     if not order_code:
         return JSONResponse({"ok": False, "error": "missing_code"}, status_code=400)
 
-    pending = get_pending_orders()
+    with file_lock(PENDING_ORDERS_FILE):
+        pending = get_pending_orders()
     order = pending.get(order_code)
     if not order:
+        if amount is not None:
+            # Đơn đã được giao (vd admin xác nhận tay) trước khi webhook tới: vẫn ghi lại thanh toán
+            try:
+                payment = {"amount": int(amount), "transaction_ref": str(payload.get("transaction_ref", "")),
+                           "source": "payment_webhook"}
+                return record_late_payment(order_code, payment)
+            except ValueError:
+                pass
         return JSONResponse({"ok": False, "error": "order_not_found"}, status_code=404)
 
     expected = int(order["price"])
@@ -2605,12 +4795,282 @@ async def payment_webhook(request: Request):
         order["status"] = "underpaid"
         pending[order_code] = order
         save_pending_orders(pending)
-        tg_send_message(order["chat_id"], f"⚠️ Bạn đã chuyển {amount:,}đ, chưa đủ {expected:,}đ.".replace(",", "."))
+        tg_send_message(order["chat_id"], f"⚠️ Bạn đã chuyển {amount:,}đ, chưa đủ {expected:,}đ.".replace(",", "."),
+                        priority=TG_PRIORITY_PAYMENT)
         send_admin_message(f"⚠️ Đơn {order_code} chuyển thiếu. Đã nhận {amount:,}đ / cần {expected:,}đ".replace(",", "."))
         return {"ok": True, "status": "underpaid"}
 
     result = auto_finalize_order(order_code, amount=amount, source="payment_webhook", transaction_ref=str(payload.get("transaction_ref", "")))
+    if not result["ok"]:
+        return JSONResponse(result, status_code=503)
     if amount > expected:
-        tg_send_message(order["chat_id"], f"ℹ️ Hệ thống ghi nhận bạn chuyển thừa {amount - expected:,}đ.".replace(",", "."))
+        tg_send_message(order["chat_id"], f"ℹ️ Hệ thống ghi nhận bạn chuyển thừa {amount - expected:,}đ.".replace(",", "."),
+                        priority=TG_PRIORITY_PAYMENT)
     send_admin_message(f"✅ Đơn {order_code} đã auto xác nhận qua payment webhook.")
-    return {"ok": True, **result}
+    return result
+
+
+# ============================================================
+# UPDATE QUEUE
+# ============================================================
+# Webhook Telegram chỉ đẩy update vào hàng đợi rồi trả OK ngay. Mỗi worker có hàng đợi
+# riêng và update được chia theo chat_id, nên các update cùng 1 chat vẫn xử lý đúng thứ tự.
+_UPDATE_QUEUES: List["queue.Queue[Optional[Dict[str, Any]]]"] = []
+_UPDATE_THREADS: List[threading.Thread] = []
+_UPDATE_LOCK = threading.Lock()
+UPDATE_STATS: Dict[str, int] = {"queued": 0, "processed": 0, "failed": 0, "overflow": 0, "duplicates": 0}
+
+# Telegram gửi lại update khi webhook trả chậm; nhớ các update_id gần nhất để bỏ bản trùng.
+# deque giữ thứ tự để đẩy id cũ ra, set để tra nhanh, bộ nhớ không vượt quá UPDATE_DEDUP_WINDOW.
+_SEEN_UPDATE_IDS: "collections.deque[int]" = collections.deque()
+_SEEN_UPDATE_SET: set = set()
+_SEEN_UPDATE_LOCK = threading.Lock()
+_UPDATE_HIGH_WATER = {"loaded": 0, "persisted": 0, "current": 0}
+
+
+def _update_chat_id(update: Dict[str, Any]) -> int:
+    cq = update.get("callback_query") or {}
+    message = update.get("message") or cq.get("message") or {}
+    chat_id = (message.get("chat") or {}).get("id") or (cq.get("from") or {}).get("id") or 0
+    try:
+        return int(chat_id)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _update_worker(q: "queue.Queue[Optional[Dict[str, Any]]]") -> None:
+    while True:
+        update = q.get()
+        try:
+            if update is None:
+                return
+            run_handler(handle_update, update)
+            UPDATE_STATS["processed"] += 1
+        except Exception as e:
+            UPDATE_STATS["failed"] += 1
+            print(f"update worker error: {e}")
+        finally:
+            q.task_done()
+            # Hết việc thì ghi storage luôn, gom ghi khi đang có nhiều update dồn dập
+            if q.empty():
+                try:
+                    persist_update_high_water()
+                    flush_user_last_seen()
+                    storage_flush()
+                except Exception as e:
+                    print(f"update worker flush error: {e}")
+
+
+def load_update_high_water() -> None:
+    if not UPDATE_DEDUP_PERSIST:
+        return
+    state = storage_read_only(UPDATE_STATE_FILE, {})
+    try:
+        last_id = int(state.get("last_update_id") or 0)
+    except (TypeError, ValueError):
+        last_id = 0
+    with _SEEN_UPDATE_LOCK:
+        _UPDATE_HIGH_WATER["loaded"] = last_id
+        _UPDATE_HIGH_WATER["persisted"] = last_id
+        _UPDATE_HIGH_WATER["current"] = max(_UPDATE_HIGH_WATER["current"], last_id)
+
+
+def persist_update_high_water() -> None:
+    if not UPDATE_DEDUP_PERSIST:
+        return
+    with _SEEN_UPDATE_LOCK:
+        current = _UPDATE_HIGH_WATER["current"]
+        if current <= _UPDATE_HIGH_WATER["persisted"]:
+            return
+        _UPDATE_HIGH_WATER["persisted"] = current
+    storage_save(UPDATE_STATE_FILE, {"last_update_id": current, "updated_at": now_ts()})
+
+
+def is_duplicate_update(update: Dict[str, Any]) -> bool:
+    try:
+        update_id = int(update.get("update_id"))
+    except (TypeError, ValueError):
+        return False
+    window = max(1, UPDATE_DEDUP_WINDOW)
+    with _SEEN_UPDATE_LOCK:
+        loaded = _UPDATE_HIGH_WATER["loaded"]
+        # Chỉ so với mốc đã lưu khi id còn gần mốc, Telegram có thể đếm lại update_id từ đầu
+        duplicate = update_id in _SEEN_UPDATE_SET or (loaded - window < update_id <= loaded)
+        if duplicate:
+            UPDATE_STATS["duplicates"] += 1
+            return True
+        _SEEN_UPDATE_IDS.append(update_id)
+        _SEEN_UPDATE_SET.add(update_id)
+        while len(_SEEN_UPDATE_IDS) > window:
+            _SEEN_UPDATE_SET.discard(_SEEN_UPDATE_IDS.popleft())
+        if update_id > _UPDATE_HIGH_WATER["current"]:
+            _UPDATE_HIGH_WATER["current"] = update_id
+    return False
+
+
+def start_update_workers() -> None:
+    with _UPDATE_LOCK:
+        if _UPDATE_THREADS or UPDATE_WORKERS <= 0:
+            return
+        per_worker = max(1, UPDATE_QUEUE_SIZE // UPDATE_WORKERS)
+        for idx in range(UPDATE_WORKERS):
+            q: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=per_worker)
+            thread = threading.Thread(target=_update_worker, args=(q,), name=f"update-worker-{idx}", daemon=True)
+            _UPDATE_QUEUES.append(q)
+            _UPDATE_THREADS.append(thread)
+            thread.start()
+
+
+def enqueue_update(update: Dict[str, Any]) -> bool:
+    queues = _UPDATE_QUEUES
+    if not queues:
+        return False
+    q = queues[_update_chat_id(update) % len(queues)]
+    try:
+        q.put_nowait(update)
+    except queue.Full:
+        UPDATE_STATS["overflow"] += 1
+        return False
+    UPDATE_STATS["queued"] += 1
+    return True
+
+
+def drain_update_workers(timeout: float = UPDATE_DRAIN_TIMEOUT) -> None:
+    with _UPDATE_LOCK:
+        queues = list(_UPDATE_QUEUES)
+        threads = list(_UPDATE_THREADS)
+        _UPDATE_QUEUES.clear()
+        _UPDATE_THREADS.clear()
+    deadline = time.time() + timeout
+    for q in queues:
+        try:
+            q.put(None, timeout=max(0.1, deadline - time.time()))
+        except queue.Full:
+            print("update queue drain timeout")
+    for thread in threads:
+        thread.join(timeout=max(0.1, deadline - time.time()))
+
+
+def update_queue_stats() -> Dict[str, Any]:
+    return {
+        **UPDATE_STATS,
+        "workers": len(_UPDATE_THREADS),
+        "pending": sum(q.qsize() for q in _UPDATE_QUEUES),
+        "dedup_window": len(_SEEN_UPDATE_IDS),
+        "last_update_id": _UPDATE_HIGH_WATER["current"],
+    }
+
+
+# ============================================================
+# API ROUTES
+# ============================================================
+@app.on_event("startup")
+def on_startup():
+    bootstrap_started_at = time.time()
+    created = ensure_bootstrap_files()
+    bootstrap_elapsed = time.time() - bootstrap_started_at
+    confirm_payos_webhook_url()
+    load_update_high_water()
+    start_update_workers()
+    resume_broadcasts()
+    print(
+        f"Startup ready in {time.time() - PROCESS_STARTED_AT:.2f}s "
+        f"(storage={get_storage().name}, bootstrap {bootstrap_elapsed:.2f}s, created: {', '.join(created) or 'none'})"
+    )
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    drain_update_workers()
+    drain_tg_outbox()
+    persist_update_high_water()
+    flush_user_last_seen(force=True)
+    storage_flush()
+
+
+@app.middleware("http")
+async def flush_writes_after_request(request: Request, call_next):
+    # Cloud Run có thể hạ CPU sau khi trả response nên ghi gist trước khi trả về.
+    # Webhook Telegram tự lo phần ghi của mình (xem telegram_webhook), không đứng chờ PATCH ở đây.
+    response = await call_next(request)
+    if request.url.path == WEBHOOK_PATH:
+        return response
+    await run_in_threadpool(flush_user_last_seen)
+    await run_in_threadpool(storage_flush)
+    return response
+
+
+@app.get("/")
+def home():
+    return {
+        "status": "running",
+        "webhook_path": WEBHOOK_PATH,
+        "webhook_url": WEBHOOK_URL,
+        "catalog_size": len(CATALOG),
+        "reminder_endpoint": "/cron/remind_expiring",
+        "payos_webhook_path": PAYOS_WEBHOOK_PATH,
+        "payos_webhook_url": PAYOS_WEBHOOK_URL,
+    }
+
+
+@app.get("/metrics")
+def metrics():
+    storage = get_storage()
+    return {
+        "storage_backend": storage.name,
+        "json_codec": JSON_CODEC,
+        "storage": storage.stats(),
+        "shards": {**SHARD_STATS, "files": {name: shard_count(name) for name in SHARDED_FILES}},
+        "http": http_stats(),
+        "updates": update_queue_stats(),
+        "telegram_outbox": tg_dispatch_stats(),
+        "unit_of_work": dict(UOW_STATS),
+        "concurrency": dict(CONCURRENCY_STATS),
+        "transactions": dict(TXN_STATS),
+        "user_writes": {**USER_WRITE_STATS, "pending_seen": len(_USER_SEEN)},
+    }
+
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    try:
+        update = await request.json()
+    except Exception:
+        return PlainTextResponse("OK")
+
+    if is_duplicate_update(update):
+        return PlainTextResponse("OK")
+
+    # Update xếp vào hàng đợi được xử lý sau khi đã trả OK, nên cần CPU luôn được cấp
+    # (Cloud Run: --no-cpu-throttling). Không có worker (UPDATE_WORKERS=0) hoặc hàng đợi đầy thì
+    # xử lý và ghi storage ngay trong request: Telegram phải chờ, tự giảm tốc độ gửi
+    if not enqueue_update(update):
+        await run_in_threadpool(run_handler, handle_update, update)
+        await run_in_threadpool(storage_flush)
+    return PlainTextResponse("OK")
+
+
+@app.post("/cron/remind_expiring")
+async def cron_remind_expiring():
+    result = await run_in_threadpool(run_handler, process_expiry_reminders)
+    return JSONResponse(result)
+
+
+@app.post(PAYOS_WEBHOOK_PATH)
+async def payos_webhook(request: Request):
+    try:
+        payload = await request.json()
+    except Exception:
+        return JSONResponse({"ok": False, "error": "invalid_json"}, status_code=400)
+
+    return await run_in_threadpool(run_handler, handle_payos_webhook, payload)
+
+
+@app.post("/payment_webhook")
+async def payment_webhook(request: Request):
+    try:
+        payload = await request.json()
+    except Exception:
+        return JSONResponse({"ok": False, "error": "invalid_json"}, status_code=400)
+
+    return await run_in_threadpool(run_handler, handle_payment_webhook, payload)
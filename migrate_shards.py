@@ -0,0 +1,15 @@
+import main_2fa_full as bot
+
+# Chia lại users.json / customers.json theo USERS_SHARDS / CUSTOMERS_SHARDS hiện tại.
+# Đặt USERS_SHARDS=1 (và CUSTOMERS_SHARDS=1) rồi chạy lại để gộp về 1 file như cũ.
+
+
+def migrate():
+    for filename in bot.SHARDED_FILES:
+        result = bot.migrate_sharded_file(filename)
+        print(f"{result['file']}: {result['records']} bản ghi, {len(result['sources'])} file nguồn -> {result['shards']} shard")
+    bot.storage_flush()
+
+
+if __name__ == "__main__":
+    migrate()